@@ -38,6 +38,12 @@ class AbstractProcessor:
         """
         pass
 
+    def close(self):
+        """
+        Let go of anything the processor keeps running between captures (worker pools). Call it on the way out.
+        """
+        pass
+
 
 class ProcessorMock(AbstractProcessor):
 
@@ -52,14 +58,81 @@ class Processor(AbstractProcessor):
     image processing libraries.
     """
 
-    def __init__(self, camera_width, camera_height, clip_rails_numpy=False):
+    def __init__(self, camera_width, camera_height, clip_rails_numpy=False, workers=1, crop_to_workspace=True,
+                 cluster_cell_size=None, cluster_workers=1, warm_start=False, prune_components=False,
+                 backend='kmeans', calibration_cache='calibration_cache', grid_model=None, scorer='points'):
         self.img_in = None
+        self.centers = None
+        self.selection = None
+        # scores of every candidate from the last final selection and their ranking (best first)
+        self.candidates = None
+        self.ranking = None
+        # summed area table and orientation field of the last capture's vein mask, for the candidates' scores. Both
+        # only get worked out when the scorer or get_ranked_candidates asks for them
+        self.vein_integral = None
+        self.orientation = None
+        self.preprocessed = None
+        self.selection_size = None
+        # 'points': final_selection's kmean points in the box, 'pixels': vein pixel density in the boxes,
+        # 'orientation': how vertical the vein runs at the center (see rank_candidates), only for the kmeans backend
+        self.scorer = scorer
+        self.clip_rails_numpy = clip_rails_numpy
+        self.workers = workers
+        # only preprocess the workspace (see iv.PreprocessPlan); apply_clahe/apply_thresholding then come back blank
+        # outside of it, so turn this off when those images get shown
+        self.crop_to_workspace = crop_to_workspace
+        # None clusters every vein pixel, otherwise the pixels get binned into cells this size first
+        self.cluster_cell_size = cluster_cell_size
+        # with more than one worker every strip gets clustered on its own in a process pool. The pool is made up
+        # front (before the preprocessing threads exist) and kept warm between captures
+        self.cluster_pool = iv.make_cluster_pool(cluster_workers) if cluster_workers > 1 else None
+        # start each capture's kmean from the last capture's centers (unless the veins moved too much)
+        self.warm_start = iv.WarmStart() if warm_start else None
+        # drop speckles and blobs from the vein mask before clustering; True for the defaults or a ComponentPruner
+        if prune_components is True:
+            prune_components = iv.ComponentPruner()
+        self.pruner = prune_components or None
+        # 'kmeans': get_centers + final_selection, 'skeleton': vein centerlines (get_centers_skeleton),
+        # 'hough': straight vein segments (get_centers_hough)
+        self.backend = backend
+        self.plan = None
+        # masks derived from the grids (gantry mask, strips); grid_id changes whenever the grids are reloaded
+        self.masks = iv.MaskCache()
+        self.grid_id = 0
+        # processed grids and position maps get cached here between runs (None to turn it off)
+        self.calibration_cache = calibration_cache
+        # None converts pixels to mm with the position maps; a path to a .npz uses the fitted GridModel saved there
+        # instead (fitted from the grids and saved the first time around, after that the grids aren't loaded at all)
+        self.grid_model_file = grid_model
+        self.grid_model = None
+        # follows the needle tip between frames (see track_needle), made on first use
+        self.needle_tracker = None
+        self.load_grids(camera_width, camera_height)
+
+        my_x = self.mm_to_steps(X_AXIS, 21.75)
+        my_y = self.mm_to_steps(Y_AXIS, 12)
+        my_z = self.mm_to_steps(Z_AXIS, 10)
+
+        print("x: {} y: {} z: {}".format(my_x, my_y, my_z))
+
+    def load_grids(self, camera_width, camera_height):
+        """
+        (Re)load the grid assets for a camera resolution. Anything derived from the old grids gets thrown out.
+        """
         #horizontal = cv2.imread('assets/coord_static_x_revised.png', 0)
         #vertical = cv2.imread('assets/coord_static_y.png', 0)
-        horizontal = cv2.imread('assets/grid_ver_smol_revised.jpg', 0)
-        vertical = cv2.imread('assets/grid_hor_smol_revised.jpg', 0)
-        self.grid_horizontal, self.grid_vertical = iv.initialize_grids((camera_height, camera_width), horizontal,
-                                                                       vertical)
+        self.frame_shape = (camera_height, camera_width)
+        self.grid_model = None
+        if self.grid_model_file is not None and os.path.isfile(self.grid_model_file):
+            self.grid_model = iv.grid.GridModel.load(self.grid_model_file)
+        if self.grid_model is not None and self.grid_model.extent is not None:
+            # the model does pixel -> mm and knows the grid's extent for the gantry mask, nothing else needs the grids
+            self.grid_horizontal = self.grid_vertical = self.position_maps = None
+        else:
+            # pixel -> mm for every pixel comes with it, so get_position is a lookup instead of walking the grid images
+            self.grid_horizontal, self.grid_vertical, self.position_maps = iv.load_calibration(
+                (camera_height, camera_width), 'assets/grid_ver_smol_revised.jpg', 'assets/grid_hor_smol_revised.jpg',
+                self.calibration_cache)
         #self.grid_horizontal = cv2.resize(self.grid_horizontal, (camera_width, camera_height))
         #self.grid_vertical = cv2.resize(self.grid_vertical, (camera_width, camera_height))
 
@@ -67,19 +140,61 @@ class Processor(AbstractProcessor):
         #cv2.imwrite('gui-gridhorizontal.jpg', self.grid_horizontal)
         #cv2.imwrite('gui-gridvertical.jpg', self.grid_vertical)
 
-        self.centers = None
-        self.selection = None
-        self.clip_rails_numpy = clip_rails_numpy
-
-        my_x = self.mm_to_steps(X_AXIS, 21.75)
-        my_y = self.mm_to_steps(Y_AXIS, 12)
-        my_z = self.mm_to_steps(Z_AXIS, 10)
+        if self.grid_model_file is not None and self.grid_vertical is not None:
+            self.fit_grid_model()
+        self.needle_tracker = None
+
+        self.grid_id += 1
+        self.masks.clear()
+        if self.grid_vertical is None:
+            self.masks.set_extent(self.grid_id, self.grid_model.extent_at)
+        if self.warm_start is not None:
+            self.warm_start.clear()
+        if self.plan is not None:
+            self.plan.close()
+            self.plan = None
+
+    def fit_grid_model(self):
+        """
+        Fit the pixel -> mm model to the current grids and save it to self.grid_model_file (replacing a model saved
+        without the grid extent). The model doesn't depend on the resolution, so one file does for every camera mode.
+        """
+        self.grid_model, rms = iv.grid.GridModel.fit(self.grid_horizontal, self.grid_vertical, self.position_maps)
+        print("grid model fitted, {:.2f} mm rms at the grid crossings".format(rms))
+        self.grid_model.save(self.grid_model_file)
 
-        print("x: {} y: {} z: {}".format(my_x, my_y, my_z))
+    def close(self):
+        """
+        Shut down the cluster processes and the preprocessing threads. Still usable afterwards: the next capture
+        builds a new plan (and thread pool) and clusters in this process.
+        """
+        if self.cluster_pool is not None:
+            self.cluster_pool.shutdown()
+            self.cluster_pool = None
+        if self.plan is not None:
+            self.plan.close()
+            self.plan = None
+
+    def get_plan(self, shape):
+        """
+        Get the preprocessing plan for this image shape, only rebuilding it when the resolution changes.
+        :param shape: shape of the image about to be processed
+        :return: PreprocessPlan
+        """
+        threshold = int(255 * 0.5)
+        key = iv.PreprocessPlan.make_key(shape, self.clip_rails_numpy, 7.0, (40, 40), threshold, 15, 20, 100,
+                                         self.workers, self.crop_to_workspace)
+        if self.plan is None or self.plan.key != key:
+            if self.plan is not None:
+                self.plan.close()
+            self.plan = iv.PreprocessPlan(shape, self.grid_vertical, self.clip_rails_numpy, 7.0, (40, 40),
+                                          threshold, 15, 20, 100, self.workers, self.crop_to_workspace,
+                                          self.masks, self.grid_id)
+        return self.plan
 
     def apply_clahe(self, image):
         self.img_in = image
-        return iv.apply_clahe(self.img_in, 7.0, (40, 40))
+        return self.get_plan(np.shape(image)).apply_clahe(self.img_in)
 
     def apply_thresholding(self, clahe_img):
         """
@@ -87,36 +202,158 @@ class Processor(AbstractProcessor):
         :param image: input image
         :return: preprocessed image
         """
-        mask = iv.create_mask(self.img_in, 100, 255)
-        threshold = int(255 * 0.5)
-        low = iv.adapt_thresh(clahe_img, 255, threshold, 15)
-        high = iv.adapt_thresh(clahe_img, 255, threshold, 20)  # we are creating a bandpass filter here
-        masked_low = iv.apply_mask(low, mask)
-        masked_high = iv.apply_mask(high, mask)
-        masked_img = masked_low - np.logical_and(masked_low, masked_high)
-        masked = masked_img.astype(np.uint8)
+        # we are creating a bandpass filter here
+        masked = self.get_plan(np.shape(clahe_img)).apply_thresholding(self.img_in, clahe_img)
         return masked
 
     def get_optimum_points(self, preprocessed_img):
-        self.centers = iv.get_centers(preprocessed_img, 40, self.grid_vertical, True, self.clip_rails_numpy)
+        plan = self.get_plan(np.shape(preprocessed_img))
+        self.vein_integral = None
+        self.orientation = None
+        self.preprocessed = preprocessed_img
+        if self.backend == 'skeleton':
+            # the skeleton and hough backends pick their site on the way, get_final_selection just hands it back
+            self.centers, self.selection = iv.get_centers_skeleton(preprocessed_img, None, plan,
+                                                                   prune=self.pruner)
+            return self.centers
+        if self.backend == 'hough':
+            self.centers, self.selection = iv.get_centers_hough(preprocessed_img, None, plan, prune=self.pruner)
+            return self.centers
+        self.centers = iv.get_centers(preprocessed_img, 40, self.grid_vertical, True, self.clip_rails_numpy, plan,
+                                      self.cluster_cell_size, self.cluster_pool, self.warm_start, self.pruner)
+        if self.pruner is not None:
+            stats = self.pruner.last_stats
+            print("pruned {} of {} components ({} of {} vein pixels)".format(
+                stats['components'] - stats['kept_components'], stats['components'],
+                stats['pixels'] - stats['kept_pixels'], stats['pixels']))
         return self.centers
 
+    def get_vein_integral(self):
+        """
+        :return: summed area table of the last capture's vein mask (see iv.vein_integral), made on first use
+        """
+        if self.vein_integral is None:
+            plan = self.get_plan(np.shape(self.preprocessed))
+            self.vein_integral = iv.vein_integral(self.preprocessed, None, plan)
+        return self.vein_integral
+
+    def get_orientation(self):
+        """
+        :return: orientation field of the last capture's vein mask (see iv.orientation_field), made on first use
+        """
+        if self.orientation is None:
+            plan = self.get_plan(np.shape(self.preprocessed))
+            self.orientation = iv.orientation_field(self.preprocessed, None, plan)
+        return self.orientation
+
     def get_final_selection(self, size, centers):
-        self.selection = iv.final_selection(centers, size, True)
+        self.selection_size = size
+        if self.backend in ('skeleton', 'hough'):
+            # sites come back worst to best, the box scores are just for reference
+            self.candidates, _ = iv.rank_candidates(centers, size)
+            self.ranking = np.arange(len(centers))[::-1]
+            return self.selection
+        if self.scorer == 'pixels':
+            self.candidates, self.ranking = iv.rank_candidates(centers, size, integral=self.get_vein_integral(),
+                                                               by='density')
+            best = self.candidates['live_pixels']
+        elif self.scorer == 'orientation':
+            # the orientation field stands in for check_box's standev
+            self.candidates, self.ranking = iv.rank_candidates(centers, size, integral=self.vein_integral,
+                                                               field=self.get_orientation(), by='orientation')
+            best = self.candidates['verticality']
+        else:
+            # same pick as iv.final_selection, but keep everyone else's scores around too
+            self.candidates, self.ranking = iv.rank_candidates(centers, size, integral=self.vein_integral)
+            best = self.candidates['npoints']
+        if len(self.ranking) and best[self.ranking[0]] > 0:
+            self.selection = int(self.ranking[0])
+        else:
+            self.selection = None
         return self.selection
 
+    def get_ranked_candidates(self, k=5):
+        """
+        The candidates scored by the last get_final_selection, e.g. to offer alternatives when the automatic pick
+        gets rejected. Whatever the scorer didn't need (the vein pixels, the angle and coherence) gets filled in
+        here the first time it's called for a capture, so call it before the next capture overwrites the
+        preprocessed image.
+        :param k: how many of the best to return (None for all of them)
+        :return: structured array with x, y, npoints, standev, avgdist, maxdist, chain, live_pixels, kill_pixels,
+                 density, angle, coherence and verticality per center (same order as centers), indices of the best k
+                 best first (the first one is the selection)
+        """
+        if self.ranking is None:
+            return None, None
+        if len(self.candidates):
+            # the ranking stays whatever get_final_selection made it, only the missing scores get filled in
+            points = np.column_stack((self.candidates['x'], self.candidates['y']))
+            if (self.candidates['live_pixels'] < 0).any():
+                live, kill = iv.box_counts(*self.get_vein_integral(), points,
+                                           iv.selection_boxes(self.selection_size))
+                self.candidates['live_pixels'], self.candidates['kill_pixels'] = live, kill
+                self.candidates['density'] = iv.box_density(live, kill, self.selection_size)
+            if np.isnan(self.candidates['angle']).all():
+                self.candidates['angle'], self.candidates['coherence'] = iv.orientation_at(self.get_orientation(),
+                                                                                           points)
+                self.candidates['verticality'] = iv.verticality(self.candidates['angle'], self.candidates['coherence'])
+        return self.candidates, self.ranking[:k]
+
     def get_injection_site_relative_to_point(self, **kwargs):
         #needle_xy_pixel = iv.isolate_needle(self.img_in, self.grid_vertical)
         if 'index' not in kwargs:
-            pt = iv.get_position(self.centers[self.selection], self.grid_horizontal, self.grid_vertical)
+            pt = iv.get_position(self.centers[self.selection], self.grid_horizontal, self.grid_vertical,
+                                 self.position_maps, self.grid_model, self.frame_shape)
         else:
-            pt = iv.get_position(self.centers[kwargs['index']], self.grid_horizontal, self.grid_vertical)
+            pt = iv.get_position(self.centers[kwargs['index']], self.grid_horizontal, self.grid_vertical,
+                                 self.position_maps, self.grid_model, self.frame_shape)
         mypt = [pt[1], pt[0]]
         return mypt
 
+    def get_centers_in_mm(self):
+        """
+        Same as get_injection_site_relative_to_point, but for every center at once.
+        :return: Nx2 array of [x, y] mm positions, one per center
+        """
+        pt = iv.get_position(np.asarray(self.centers).reshape(-1, 2), self.grid_horizontal, self.grid_vertical,
+                             self.position_maps, self.grid_model, self.frame_shape)
+        return np.column_stack((pt[1], pt[0]))
+
+    def get_pixels_from_mm(self, points):
+        """
+        Inverse of get_centers_in_mm, e.g. to draw the workspace or the planned needle path over the camera image.
+        Only there with a grid_model: then both directions go through the same GridModel and round trip exactly.
+        The position maps can't be inverted, a good part of the workspace has other pixels further than 10 px
+        away that the maps put within 0.15 mm of the same position.
+        :param points: an [x, y] mm position or an Nx2 array of them, same axes as get_centers_in_mm
+        :return: [x, y] pixel position(s) in the camera image
+        """
+        if self.grid_model is None:
+            raise ValueError("mm -> pixel needs a grid_model (see Processor), the position maps can't be inverted")
+        points = np.asarray(points, dtype=np.float64)
+        flat = points.reshape(-1, 2)
+        pixels = self.grid_model.inverse(flat[:, 1], flat[:, 0], self.frame_shape)
+        return pixels.reshape(points.shape)
+
+    def track_needle(self, image, hint=None):
+        """
+        Needle tip for a camera frame, cheap enough to call every frame: only the first frame (or one where the
+        needle got lost) is processed whole, after that just a window around the last tip.
+        :param image: grayscale camera frame
+        :param hint: optional [x, y] pixel position to look around instead, e.g. get_pixels_from_mm of where the
+                     gantry was just sent
+        :return: [x, y] pixel position of the needle tip, None if there's no needle
+        """
+        if self.needle_tracker is None:
+            self.needle_tracker = iv.NeedleTracker(self.masks.grid_mask(self.grid_vertical, self.grid_id,
+                                                                        shape=np.shape(image)))
+        return self.needle_tracker.update(image, hint)
+
     def get_correction_relative_to_point(self):
-        needle_xy_pixel = iv.isolate_needle(self.img_in, self.grid_vertical)
-        pt = iv.compare_points(self.centers[self.selection], needle_xy_pixel, self.grid_horizontal, self.grid_vertical)
+        mask_grid = self.masks.grid_mask(self.grid_vertical, self.grid_id, shape=np.shape(self.img_in))
+        needle_xy_pixel = iv.isolate_needle(self.img_in, self.grid_vertical, mask_grid=mask_grid)
+        pt = iv.compare_points(self.centers[self.selection], needle_xy_pixel, self.grid_horizontal, self.grid_vertical,
+                               self.position_maps, self.grid_model, self.frame_shape)
         # TODO: why to get this to work we had to flip the axes and offset the x by 10 :)
         realpt = [pt[1]-10, pt[0]]
         return realpt
@@ -54,6 +54,10 @@ GFX_ON_START = True
 GFX_AUTO_ROTATE = True
 
 STILL_IMAGE_CAPTURE = 0 # broken, don't use.
+PREPROCESSING_WORKERS = 1  # threads for the tiled preprocessing, 1 turns tiling off
+CLUSTER_WORKERS = 1  # processes for the per strip clustering (picks differ from the two big kmeans), 1 keeps those
+SELECTION_BACKEND = 'kmeans'  # 'kmeans', 'skeleton' or 'hough', see api.Processor
+CROP_TO_WORKSPACE = False  # True only preprocesses the workspace, but the CLAHE and mask previews go blank outside it
 
 """
 To see how much clipping when CLIP_RAILS_THROUGH_NUMPY see prostick_lib.py
@@ -211,9 +215,13 @@ def get_processor():
         return api.ProcessorMock()
     else:
         if CROPPING_ENABLED:
-            return api.Processor(CROPPED_RESOLUTION_WIDTH, CROPPED_RESOLUTION_HEIGHT, clip_rails_numpy=CLIP_RAILS_THROUGH_NUMPY)
+            return api.Processor(CROPPED_RESOLUTION_WIDTH, CROPPED_RESOLUTION_HEIGHT, clip_rails_numpy=CLIP_RAILS_THROUGH_NUMPY,
+                                 workers=PREPROCESSING_WORKERS, cluster_workers=CLUSTER_WORKERS,
+                                 crop_to_workspace=CROP_TO_WORKSPACE, backend=SELECTION_BACKEND)
         else:
-            return api.Processor(CAMERA_RESOLUTION_WIDTH, CAMERA_RESOLUTION_HEIGHT, clip_rails_numpy=CLIP_RAILS_THROUGH_NUMPY)
+            return api.Processor(CAMERA_RESOLUTION_WIDTH, CAMERA_RESOLUTION_HEIGHT, clip_rails_numpy=CLIP_RAILS_THROUGH_NUMPY,
+                                 workers=PREPROCESSING_WORKERS, cluster_workers=CLUSTER_WORKERS,
+                                 crop_to_workspace=CROP_TO_WORKSPACE, backend=SELECTION_BACKEND)
 
 def get_controller():
     if MOCK_MODE_GANTRY:
@@ -981,6 +989,7 @@ class MainWindow(QMainWindow):
         # TODO: deem if this is a necessary functionality or if we will keep it in arduino code
 
     def close_event(self):
+        self.processor.close()
         qApp.exit()
 
     def settings_event(self):
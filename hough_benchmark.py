@@ -0,0 +1,49 @@
+""" Hough selection benchmark
+
+Runs the k-means selection (get_optimum_points + get_final_selection) and the Hough segment selection
+(get_centers_hough) on the same preprocessed images from last_tests/ and prints how long each one takes and how far
+apart (in mm, through the grids) the two sites end up.
+
+Run it from the repository root: python hough_benchmark.py [width height]
+"""
+
+import api
+import cv2
+import glob
+import numpy as np
+import sys
+import time
+import image_processing.prostick_lib as iv
+
+
+if __name__ == "__main__":
+    width, height = (int(sys.argv[1]), int(sys.argv[2])) if len(sys.argv) > 2 else (3280, 2464)
+    processor = api.Processor(width, height, clip_rails_numpy=True)
+    times_kmean, times_hough, distances = [], [], []
+    for name in sorted(glob.glob('last_tests/*.jpg')):
+        img = cv2.resize(cv2.imread(name, 0), (width, height))
+        preprocessed = processor.apply_thresholding(processor.apply_clahe(img))
+
+        start = time.time()
+        centers = processor.get_optimum_points(preprocessed)
+        selection = processor.get_final_selection(np.shape(preprocessed), centers)
+        times_kmean.append(time.time() - start)
+
+        start = time.time()
+        sites, best = iv.get_centers_hough(preprocessed, None, processor.plan)
+        times_hough.append(time.time() - start)
+
+        if selection is None or best is None:
+            print("{}: no site (kmean {}, hough {})".format(name, selection, best))
+            continue
+        site_kmean = iv.get_position(centers[selection], processor.grid_horizontal, processor.grid_vertical)
+        site_hough = iv.get_position(sites[best], processor.grid_horizontal, processor.grid_vertical)
+        distances.append(np.hypot(site_kmean[0] - site_hough[0], site_kmean[1] - site_hough[1]))
+        print("{}: kmean {:.3f} s at {}, hough {:.3f} s at {}, {:.1f} mm apart".format(
+            name, times_kmean[-1], np.round(centers[selection]), times_hough[-1], np.round(sites[best]),
+            distances[-1]))
+
+    print("median kmean {:.3f} s, hough {:.3f} s".format(np.median(times_kmean), np.median(times_hough)))
+    if distances:
+        print("sites within 5 mm: {} of {}, median distance {:.1f} mm".format(
+            sum(d <= 5 for d in distances), len(distances), np.median(distances)))
@@ -17,27 +17,300 @@ import numpy as np
 import cv2
 import scipy as sp
 import scipy.ndimage
+import scipy.spatial
 import image_processing.spooky_lib as grid
 from matplotlib import pyplot as plt
 from math import tan, atan
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict
+import hashlib
+import os
+import shutil
+import tempfile
 
 
-def get_centers(image, nclusters, grid_horizontal, preprocessed=False, enable_gantry_rails=True):
+def get_centers(image, nclusters, grid_horizontal, preprocessed=False, enable_gantry_rails=True, plan=None,
+                cell_size=None, pool=None, warm=None, prune=None):
     """
     :param image: image taken by the Raspberry Pi camera
     :param nclusters: number of clusters to run the algorithm with; make sure this is divisible by 2
     :param grid_horizontal:
+    :param plan: optional PreprocessPlan for this resolution; its static masks and buffers are reused
+    :param cell_size: if set, cluster the vein pixels binned into cell_size x cell_size cells instead of every
+                      single pixel (see execute_kmean_binned)
+    :param pool: optional process pool (see make_cluster_pool); every strip gets clustered as its own job on it
+                 instead of one kmean per strip set (see cluster_strip_bands)
+    :param warm: optional WarmStart; the kmean starts from the previous capture's centers when the veins haven't
+                 moved much since, and the new centers get stored in it for the next capture
+    :param prune: optional ComponentPruner to throw out speckles and blobs before clustering
     :return: kmean clusters (for plotting purposes)
     """
     image_size = np.shape(image)
-    mask_grid = grid_mask(grid_horizontal, enable_gantry_rails)
-    pic_array_1, pic_array_2 = process_selection_image(image, 0.5, mask_grid, preprocessed)
-    centers_first = execute_kmean(pic_array_1, int(nclusters/2))
-    centers_second = execute_kmean(pic_array_2, int(nclusters/2))
-    centers = np.concatenate((centers_first, centers_second), axis=0)
+    if plan is not None:
+        mask_grid = None  # the plan has its own
+    else:
+        mask_grid = grid_mask(grid_horizontal, enable_gantry_rails)
+    pic_array_1, pic_array_2 = process_selection_image(image, 0.5, mask_grid, preprocessed, plan, prune)
+    init_first, init_second = None, None
+    if warm is not None:
+        init_first = warm.init_for(image_size, 0, pic_array_1)
+        init_second = warm.init_for(image_size, 1, pic_array_2)
+    if pool is not None:
+        centers = cluster_strip_bands(pic_array_1, pic_array_2, nclusters, image_size[1], pool, cell_size,
+                                      inits=(init_first, init_second))
+    else:
+        if cell_size:
+            centers_first = execute_kmean_binned(pic_array_1, int(nclusters/2), cell_size, init_first)
+            centers_second = execute_kmean_binned(pic_array_2, int(nclusters/2), cell_size, init_second)
+        else:
+            centers_first = execute_kmean(pic_array_1, int(nclusters/2), init_first)
+            centers_second = execute_kmean(pic_array_2, int(nclusters/2), init_second)
+        centers = np.concatenate((centers_first, centers_second), axis=0)
+    if warm is not None:
+        warm.update(image_size, 0, pic_array_1, centers[:int(nclusters/2)])
+        warm.update(image_size, 1, pic_array_2, centers[int(nclusters/2):])
     return centers
 
 
+def get_centers_skeleton(image, mask_grid, plan=None, nsites=40, section_len=100, max_angle=20.0, prune=None):
+    """
+    :param image: preprocessed (thresholded) image, veins are 0
+    :param mask_grid: gantry mask (ignored when a plan is given, it has its own)
+    :param plan: optional PreprocessPlan; only its workspace rectangle gets looked at
+    :param nsites: at most this many candidate sites come back
+    :param section_len: length of the vein sections at 2464 rows (scaled with the image height)
+    :param max_angle: sections further than this (in degrees) from vertical only get picked if nothing else is left
+    :param prune: optional ComponentPruner to run on the vein mask first
+    :return: candidate sites as an Mx2 array of [x, y] (worst to best), index of the final selection (or None)
+
+    Alternative to get_centers + final_selection. The README's goal is the widest vein at its most gantry parallel
+    section, so instead of clustering pixels and counting neighbours in a box this measures that directly: take
+    the vein centerlines and their widths (see vein_segments), cut them into sections and pick the widest one
+    that is long and close to vertical. Every step is a fixed number of passes over the image, no clustering.
+    """
+    veins, (x0, y0) = vein_mask(image, mask_grid, plan)
+    if prune is not None:
+        prune(veins, np.shape(image))
+    section_len = max(int(round(section_len * np.shape(image)[0] / 2464)), 2)
+    segments = vein_segments(veins, section_len)
+    if len(segments) == 0:
+        return np.empty((0, 2)), None
+    # widest vein wins, knocked down for sections that are short or slanted
+    fill = np.minimum(segments['length'] / section_len, 1.0)
+    upright = np.cos(np.radians(segments['angle']))**2
+    score = segments['width'] * fill * upright
+    # sections that are too slanted or too short only count when there's nothing else
+    score[(segments['angle'] > max_angle) | (fill < 0.5)] -= score.max() + 1
+    order = np.argsort(score, kind='stable')[-nsites:]
+    sites = np.column_stack((segments['x'][order] + x0, segments['y'][order] + y0))
+    return sites, len(sites) - 1
+
+
+def get_centers_hough(image, mask_grid, plan=None, nsites=40, min_length=150, max_gap=10, max_angle=20.0,
+                      prune=None):
+    """
+    :param image: preprocessed (thresholded) image, veins are 0
+    :param mask_grid: gantry mask (ignored when a plan is given, it has its own)
+    :param plan: optional PreprocessPlan; only its workspace rectangle gets looked at
+    :param nsites: at most this many candidate sites come back
+    :param min_length: shortest segment to consider, in pixels at 2464 rows (scaled with the image height)
+    :param max_gap: largest gap a segment can bridge, in pixels at 2464 rows
+    :param max_angle: segments further than this (in degrees) from vertical only get picked if nothing else is left
+    :param prune: optional ComponentPruner to run on the vein mask first
+    :return: candidate sites as an Mx2 array of [x, y] (worst to best), index of the final selection (or None)
+
+    Another alternative to get_centers + final_selection, grown out of archived/straight_line_detection.py: the
+    most gantry parallel part of a vein is a long straight piece running up and down the image, which is exactly
+    what the probabilistic Hough transform finds. It runs straight on the vein mask (the veins are already lines,
+    no need for Canny), and the segments get scored by length times cos^2 of their angle from vertical. The site is
+    the middle of the segment.
+    """
+    veins, (x0, y0) = vein_mask(image, mask_grid, plan)
+    if prune is not None:
+        prune(veins, np.shape(image))
+    scale = np.shape(image)[0] / 2464
+    min_length = max(min_length * scale, 2)
+    lines = cv2.HoughLinesP(veins, 1, np.pi / 180, int(min_length / 2), None, min_length, max(max_gap * scale, 1))
+    if lines is None:
+        return np.empty((0, 2)), None
+    lines = lines.reshape(-1, 4).astype(np.float64)
+    dx, dy = lines[:, 2] - lines[:, 0], lines[:, 3] - lines[:, 1]
+    length = np.hypot(dx, dy)
+    angle = np.degrees(np.arctan2(np.abs(dx), np.abs(dy)))
+    score = length * np.cos(np.radians(angle))**2
+    score[angle > max_angle] -= score.max() + 1
+    order = np.argsort(score, kind='stable')[-nsites:]
+    mid_x = (lines[order, 0] + lines[order, 2]) / 2 + x0
+    mid_y = (lines[order, 1] + lines[order, 3]) / 2 + y0
+    sites = np.column_stack((mid_x, mid_y))
+    return sites, len(sites) - 1
+
+
+def vein_mask(image, mask_grid, plan=None):
+    """
+    :param image: preprocessed (thresholded) image, veins are 0
+    :param mask_grid: gantry mask (ignored when a plan is given, it has its own)
+    :param plan: optional PreprocessPlan; only its workspace rectangle gets looked at
+    :return: 0/1 uint8 mask of the veins inside the gantry mask and the [x, y] of its top left corner in the image
+    """
+    if plan is not None:
+        y0, y1, x0, x1 = plan.roi
+        veins = np.equal(image[y0:y1, x0:x1], 0).view(np.uint8)
+        np.bitwise_and(veins, plan.roi_mask_grid, out=veins)
+    else:
+        y0, x0 = 0, 0
+        veins = np.equal(image, 0).view(np.uint8)
+        np.bitwise_and(veins, np.asarray(mask_grid, dtype=np.uint8), out=veins)
+    return veins, (x0, y0)
+
+
+def vein_integral(image, mask_grid, plan=None):
+    """
+    :param image: preprocessed (thresholded) image, veins are 0
+    :param mask_grid: gantry mask (ignored when a plan is given, it has its own)
+    :param plan: optional PreprocessPlan
+    :return: summed area table of the vein mask (see vein_mask and cv2.integral) and the [x, y] of its origin, for
+             box_counts
+    """
+    veins, origin = vein_mask(image, mask_grid, plan)
+    return cv2.integral(veins), origin
+
+
+def box_counts(integral, origin, points, box):
+    """
+    :param integral: summed area table from vein_integral
+    :param origin: [x, y] of the table's origin in the image
+    :param points: Nx2 array of [x, y] box centers
+    :param box: box width and height, or an Mx2 array of them to try several sizes at once
+    :return: number of vein pixels in the box around every point (N, or MxN for several boxes)
+
+    Same boxes as check_box: a pixel counts if it's strictly inside, and whatever hangs off the image (or the
+    workspace) just doesn't count. Each box is four lookups in the table no matter how big it is.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2) - origin
+    boxes = np.atleast_2d(np.asarray(box, dtype=np.float64))
+    height, width = integral.shape[0] - 1, integral.shape[1] - 1
+    half_w, half_h = boxes[:, 0, None] / 2, boxes[:, 1, None] / 2
+    # first and one past the last pixel strictly inside the box, clipped to the table
+    x0 = np.clip(np.floor(points[:, 0] - half_w) + 1, 0, width).astype(np.intp)
+    x1 = np.clip(np.ceil(points[:, 0] + half_w), 0, width).astype(np.intp)
+    y0 = np.clip(np.floor(points[:, 1] - half_h) + 1, 0, height).astype(np.intp)
+    y1 = np.clip(np.ceil(points[:, 1] + half_h), 0, height).astype(np.intp)
+    x1, y1 = np.maximum(x1, x0), np.maximum(y1, y0)
+    counts = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+    return counts[0] if np.ndim(box) == 1 else counts
+
+
+def orientation_field(image, mask_grid, plan=None, sigma=8.0, downscale=4):
+    """
+    :param image: preprocessed (thresholded) image, veins are 0
+    :param mask_grid: gantry mask (ignored when a plan is given, it has its own)
+    :param plan: optional PreprocessPlan
+    :param sigma: how far (in full resolution pixels, at 2464 rows) the structure tensor gets smoothed over
+    :param downscale: the field is worked out on the vein mask shrunk by this much
+    :return: (angle, coherence, origin, downscale) for orientation_at. angle is how far the veins run from vertical
+             in degrees (0 is parallel to the gantry's y axis), coherence goes from 0 (no clear direction) to 1
+             (everything lines up)
+
+    Standard structure tensor: Sobel gradients of the vein mask, the products gx*gx, gy*gy and gx*gy smoothed with
+    a gaussian, and the dominant gradient direction and how strongly it dominates from those. The veins run
+    perpendicular to the gradient. The orientation only changes slowly across the image so it's worked out on a
+    shrunk copy of the mask; at full resolution the blurs cost more than the rest of the selection put together.
+    """
+    veins, origin = vein_mask(image, mask_grid, plan)
+    small = cv2.resize(veins.astype(np.float32), None, fx=1 / downscale, fy=1 / downscale,
+                       interpolation=cv2.INTER_AREA)
+    gx = cv2.Sobel(small, cv2.CV_32F, 1, 0, ksize=3)
+    gy = cv2.Sobel(small, cv2.CV_32F, 0, 1, ksize=3)
+    small_sigma = max(sigma * np.shape(image)[0] / 2464 / downscale, 0.5)
+    jxx = cv2.GaussianBlur(gx * gx, (0, 0), small_sigma)
+    jyy = cv2.GaussianBlur(gy * gy, (0, 0), small_sigma)
+    jxy = cv2.GaussianBlur(gx * gy, (0, 0), small_sigma)
+    # gradient direction measured from the x axis = vein direction measured from the y axis
+    angle = np.degrees(np.abs(0.5 * np.arctan2(2 * jxy, jxx - jyy)))
+    coherence = np.sqrt((jxx - jyy)**2 + 4 * jxy**2) / (jxx + jyy + 1e-6)
+    return angle, coherence, origin, downscale
+
+
+def orientation_at(field, points):
+    """
+    :param field: from orientation_field
+    :param points: Nx2 array of [x, y] points in the image
+    :return: vein angle from vertical (degrees) and coherence at every point, nan outside the field
+    """
+    angle, coherence, origin, downscale = field
+    points = (np.asarray(points, dtype=np.float64).reshape(-1, 2) - origin) / downscale
+    col = np.floor(points[:, 0]).astype(np.intp)
+    row = np.floor(points[:, 1]).astype(np.intp)
+    inside = (col >= 0) & (col < angle.shape[1]) & (row >= 0) & (row < angle.shape[0])
+    at_angle = np.full(len(points), np.nan)
+    at_coherence = np.full(len(points), np.nan)
+    at_angle[inside] = angle[row[inside], col[inside]]
+    at_coherence[inside] = coherence[row[inside], col[inside]]
+    return at_angle, at_coherence
+
+
+def vein_segments(veins, section_len=100):
+    """
+    :param veins: 0/1 uint8 vein mask
+    :param section_len: centerlines get cut into pieces this many rows tall
+    :return: structured array with one entry per vein section: x, y (the centerline pixel closest to the middle of
+             the section), length (centerline pixels), width (average vein width in pixels), angle (degrees from
+             vertical) and label (which connected centerline the section belongs to)
+
+    The centerline is the ridge of the distance transform taken across the rows: a pixel is on it if it's further
+    from the vein edge than its left and right neighbours (ties go to the leftmost one), so there's one centerline
+    pixel per vein per row and the distance there is half the vein width. That only traces veins running more up
+    and down than sideways, but those are the only ones the gantry can use anyway; flat veins break up into short
+    pieces that don't score well. The centerline pixels are grouped by connected centerline and section_len row
+    band, and the section stats are all sums over those groups (bincount).
+    """
+    dist = cv2.distanceTransform(veins, cv2.DIST_L2, 3)
+    left = np.zeros_like(dist)
+    left[:, 1:] = dist[:, :-1]
+    right = np.zeros_like(dist)
+    right[:, :-1] = dist[:, 1:]
+    ridge = ((dist > left) & (dist >= right)).view(np.uint8)
+    _, labels = cv2.connectedComponents(ridge, connectivity=8)
+    ys, xs = np.nonzero(ridge)
+    dtype = [('x', np.float64), ('y', np.float64), ('length', np.int64), ('width', np.float64),
+             ('angle', np.float64), ('label', np.int32)]
+    if len(xs) == 0:
+        return np.empty(0, dtype=dtype)
+    label = labels[ys, xs]
+    nbands = np.shape(veins)[0] // section_len + 1
+    section = label.astype(np.int64) * nbands + ys // section_len
+    section_ids, section = np.unique(section, return_inverse=True)
+    section = section.ravel()
+
+    def total(weights=None):
+        return np.bincount(section, weights=weights, minlength=len(section_ids))
+
+    count = total()
+    xs_f, ys_f = xs.astype(np.float64), ys.astype(np.float64)
+    mean_x, mean_y = total(xs_f) / count, total(ys_f) / count
+    var_x = total(xs_f * xs_f) / count - mean_x**2
+    var_y = total(ys_f * ys_f) / count - mean_y**2
+    cov_xy = total(xs_f * ys_f) / count - mean_x * mean_y
+    # direction of the section's main axis, measured from the y axis
+    angle = np.degrees(np.abs(0.5 * np.arctan2(2 * cov_xy, var_y - var_x)))
+    width = 2 * total(dist[ys, xs]) / count
+    # the site is the centerline pixel closest to the section's centroid, so it's always on the vein
+    off_center = (xs_f - mean_x[section])**2 + (ys_f - mean_y[section])**2
+    closest = np.lexsort((off_center, section))
+    first = np.searchsorted(section[closest], np.arange(len(section_ids)))
+    site = closest[first]
+
+    segments = np.empty(len(section_ids), dtype=dtype)
+    segments['x'] = xs[site]
+    segments['y'] = ys[site]
+    segments['length'] = count
+    segments['width'] = width
+    segments['angle'] = angle
+    segments['label'] = section_ids // nbands
+    return segments
+
+
 def test_db(image, grid_horizontal):
     """
     For testing DB scan
@@ -54,7 +327,7 @@ def test_db(image, grid_horizontal):
     core_samples_mask[db.core_sample_indices_] = True
     labels = db.labels_
     n_clusters_ = len(set(labels)) - (1 if -1 in labels else 0)
-    n_noise_ = list(labels).count(-1)
+    n_noise_ = np.count_nonzero(labels == -1)
     unique_labels = set(labels)
     colors = [plt.cm.Spectral(each)
               for each in np.linspace(0, 1, len(unique_labels))]
@@ -77,43 +350,101 @@ def test_db(image, grid_horizontal):
     plt.show()
 
 
-def process_selection_image(img_in, threshold, mask_grid, preprocessed=False):
+def process_selection_image(img_in, threshold, mask_grid, preprocessed=False, plan=None, prune=None):
     """
     :param img_in: image taken by the Raspberry Pi camera
     :param threshold: 0 to 1 analog value, selected threshold for the adaptive thresholding step; this function will be
             used in the grid system, needle check, and main algorithm sections.
     :param mask_grid: defined masking area from the grid images
     :param preprocessed: bool whether or not the image has already been preprocessed
-    :return: the processed image POINTS that will be further analyzed (a 2xN numpy array)
+    :param plan: optional PreprocessPlan; when given its strips and buffers are used instead of new arrays
+    :param prune: optional ComponentPruner, run on the vein mask before it gets split into the strips
+    :return: the processed image POINTS that will be further analyzed (two Nx2 int32 arrays of [x, y], one per
+             strip set)
 
     Algorithm Process is as follows:
     1) Apply the CLAHE
     2) Create the image mask
     3) Apply adaptive mean thresholding
     4) Apply the mask to the image created by (3)
-    5) Extract the remaining points and return a 2xN numpy array
+    5) Optionally drop the connected components that don't look like veins
+    6) Extract the remaining points and return them as Nx2 numpy arrays
     """
     if not preprocessed:
         clahe_img = apply_clahe(img_in, 7.0, (40, 40))
-        mask = create_mask(img_in, 100, 255)
         threshold = int(255*threshold)
-        low = adapt_thresh(clahe_img, 255, threshold, 10)
-        high = adapt_thresh(clahe_img, 255, threshold, 20)  # we are creating a bandpass filter here
-        #adapt_mean_th = adapt_thresh(low, 255, threshold, 15)
-        masked_low = apply_mask(low, mask)
-        masked_high = apply_mask(high, mask)
-        masked_img = masked_low - np.logical_and(masked_low, masked_high)
+        # we are creating a bandpass filter here
+        masked_img = bandpass_thresh(clahe_img, img_in, threshold, 10, 20)
     else:
         masked_img = img_in
+    frame_shape = np.shape(masked_img)
+    if plan is not None:
+        # only look inside the workspace, the points get shifted back to frame coordinates at the end
+        y0, y1, x0, x1 = plan.roi
+        masked_img = masked_img[y0:y1, x0:x1]
+        mask_grid = plan.roi_mask_grid
+        horizontal_v1, horizontal_v2 = plan.strips, plan.strips_inv
+        veins, masked_img1, masked_img2 = plan.selection_bufs
+        offset = [x0, y0]
+    else:
+        mask_grid = np.asarray(mask_grid, dtype=np.uint8)
+        horizontal_v1 = strip_rows(*np.shape(masked_img))
+        horizontal_v2 = 1 - horizontal_v1
+        veins, masked_img1, masked_img2 = (np.empty(np.shape(masked_img), dtype=np.uint8) for _ in range(3))
+        offset = [0, 0]
     # for some reason this bit level logic on the images was really hard for me to do...
-    masked_img = (np.logical_and(mask_grid, masked_img)) + np.logical_not(mask_grid)
-    horizontal_v1 = create_strips(masked_img)
-    horizontal_v2 = np.logical_not(horizontal_v1)
-    masked_img1 = np.logical_not((np.logical_or(horizontal_v1, masked_img)))
-    masked_img2 = np.logical_not((np.logical_or(horizontal_v2, masked_img)))
+    # the veins are the black pixels inside the gantry mask, then split them between the two sets of strips.
+    # Everything is a 0/1 uint8 mask and done in place (the strips are a column, so they just broadcast)
+    np.equal(masked_img, 0, out=veins)
+    np.bitwise_and(veins, mask_grid, out=veins)
+    if prune is not None:
+        prune(veins, frame_shape)
+    np.bitwise_and(veins, horizontal_v2, out=masked_img1)
+    np.bitwise_and(veins, horizontal_v1, out=masked_img2)
     pic_array1 = extract_points(masked_img1)
     pic_array2 = extract_points(masked_img2)
-    return np.array(pic_array1), np.array(pic_array2)
+    pic_array1 += offset
+    pic_array2 += offset
+    return pic_array1, pic_array2
+
+
+class ComponentPruner:
+    """
+    Drops the connected components of the vein mask that are too small (speckles from the thresholding) or not
+    elongated enough (blobs, bits of rail) to be a vein, so they never get clustered or scored.
+
+    Elongation is the longer side of the component's bounding box squared over its area: about L/w for a line of
+    length L and width w (half that for a diagonal one) and close to 1 for anything round or square. min_area is
+    given for a 3280x2464 frame and scaled with the frame area. At that size most components are under 50 pixels
+    but only hold around 15% of the vein pixels.
+
+    The counts from the last call are kept in last_stats.
+    """
+
+    def __init__(self, min_area=50, min_elongation=2.0, reference_shape=(2464, 3280)):
+        self.min_area = min_area
+        self.min_elongation = min_elongation
+        self.reference_shape = reference_shape
+        self.last_stats = None
+
+    def __call__(self, veins, frame_shape=None):
+        """
+        :param veins: 0/1 uint8 vein mask, pruned in place
+        :param frame_shape: shape of the full frame (veins may be a crop of it), for scaling min_area
+        :return: veins
+        """
+        if frame_shape is None:
+            frame_shape = np.shape(veins)
+        scale = (frame_shape[0] * frame_shape[1]) / (self.reference_shape[0] * self.reference_shape[1])
+        ncomponents, labels, stats, _ = cv2.connectedComponentsWithStats(veins, connectivity=8)
+        area = stats[:, cv2.CC_STAT_AREA]
+        longest = np.maximum(stats[:, cv2.CC_STAT_WIDTH], stats[:, cv2.CC_STAT_HEIGHT]).astype(np.float64)
+        keep = (area >= self.min_area * scale) & (longest**2 >= self.min_elongation * area)
+        keep[0] = False  # background
+        np.take(keep.astype(np.uint8), labels, out=veins)
+        self.last_stats = {'components': ncomponents - 1, 'kept_components': int(keep.sum()),
+                           'pixels': int(area[1:].sum()), 'kept_pixels': int(area[keep].sum())}
+        return veins
 
 
 def final_selection(centers, size, index=False):
@@ -128,30 +459,206 @@ def final_selection(centers, size, index=False):
     box around each kmean point and analyzing how many points are above and below it as well as their respective
     variances. Also using a function sort_and_compare where we compare the relative y distances from point to point.
     The lower the relative distance from point to point, the better.
+
+    The boxes for all the points get scored in one go by score_boxes, which counts exactly the points check_box
+    counts point by point (and the pick only looks at the counts).
     """
-    final_selection = None
-    hold = [0, 1000, 1000, 1000]
-    for i in range(0, len(centers)):
-        each = centers[i]
-        # original box_friend dimensions were 60x300 for a 3280, 2464 array
-        # so the ratio is x/3280 and y/2464
-        box_friends = [100 * size[0] / 3280, 300 * size[1] / 2464]  # dimensions of box to check with
-        box_enemies = [300 * size[0] / 3280,
-                       60 * size[1] / 2464]  # don't forget, dividy by 2 so it's larger than appears!
-        [npoints, standev, avgdist, maxdist] = check_box(each, centers, box_friends, box_enemies)
-        """
-        Ironically, this fucntion works better if we ignore the number of points and instead use the
-        standard deviation of the xcoordinates only as the check. I verified this while I was messing
-        around with different images. - JPS
-        """
-        if npoints > hold[0]: # and standev < hold[1]
-            hold = [npoints, standev, avgdist, maxdist]
-            if index:
-                final_selection = i
-            else:
-                final_selection = each
+    box_friends, box_enemies = selection_boxes(size)
+    scores = score_boxes(centers, box_friends, box_enemies)
+    """
+    Ironically, this fucntion works better if we ignore the number of points and instead use the
+    standard deviation of the xcoordinates only as the check. I verified this while I was messing
+    around with different images. - JPS
+    """
+    # first point with the most points in its box wins (and it needs at least one)
+    if len(scores) == 0 or scores['npoints'].max() <= 0:
+        return None
+    i = int(np.argmax(scores['npoints']))
+    if index:
+        return i
+    return centers[i]
+
+
+def selection_boxes(size):
+    """
+    :param size: size of image array
+    :return: box_friends, box_enemies; the live and kill boxes final_selection hands to check_box
+    """
+    # original box_friend dimensions were 60x300 for a 3280, 2464 array
+    # so the ratio is x/3280 and y/2464
+    box_friends = [100 * size[0] / 3280, 300 * size[1] / 2464]  # dimensions of box to check with
+    box_enemies = [300 * size[0] / 3280,
+                   60 * size[1] / 2464]  # don't forget, dividy by 2 so it's larger than appears!
+    return box_friends, box_enemies
+
+
+def rank_candidates(centers, size, k=None, integral=None, field=None, by='npoints'):
+    """
+    :param centers: kmean dataset
+    :param size: size of image array (same as for final_selection)
+    :param k: only return the k best (all of them when None)
+    :param integral: optional (table, origin) from vein_integral, to also count the vein pixels in the boxes
+    :param field: optional orientation_field, to also look up the vein angle and coherence at every center
+    :param by: 'npoints' to rank the way final_selection does, 'density' to rank by the vein pixels instead (needs
+               the integral), 'orientation' to rank by how vertical the veins run (needs the field)
+    :return: structured array with x, y, the check_box scores, the chain length (see chain_lengths, neighbours
+             up to half a friends box apart), the vein pixels in the friends and enemies boxes (see box_counts,
+             -1 without an integral) and their density (see box_density, nan without an integral) and the angle
+             from vertical, coherence and verticality (see orientation_at and verticality, nan without a field) of
+             every center, in the same order as centers, and the indices of the best k, best first
+
+    The 'npoints' ranking is the one final_selection uses: most points in the box first, ties going to whichever
+    comes first in centers. So order[0] is final_selection(centers, size, True) as long as its box isn't empty, and
+    the rest are the runner ups in order.
+
+    The 'density' ranking looks at the veins themselves instead of the kmean points around a center: the share of
+    the tall friends box that is vein minus the share of the wide enemies box that is. A vein going up and down
+    through the center fills more of the first, one going across fills more of the second, so the best scored
+    center sits on the most vein running along the gantry with the least crossing it.
+
+    The 'orientation' ranking reads the straightness off the orientation field instead of the x spread of the kmean
+    points in the box (check_box's standev): the center on the most clearly vertical vein wins.
+    """
+    box_friends, box_enemies = selection_boxes(size)
+    scores = score_boxes(centers, box_friends, box_enemies)
+    candidates = np.zeros(len(scores), dtype=[('x', np.float64), ('y', np.float64)] + BOX_SCORE_DTYPE +
+                          [('chain', np.int64), ('live_pixels', np.int64), ('kill_pixels', np.int64),
+                           ('density', np.float64), ('angle', np.float64), ('coherence', np.float64),
+                           ('verticality', np.float64)])
+    candidates['live_pixels'] = candidates['kill_pixels'] = -1
+    candidates['density'] = candidates['angle'] = candidates['coherence'] = candidates['verticality'] = np.nan
+    if len(scores):
+        candidates['x'] = np.asarray(centers)[:, 0]
+        candidates['y'] = np.asarray(centers)[:, 1]
+        for name, _ in BOX_SCORE_DTYPE:
+            candidates[name] = scores[name]
+        candidates['chain'] = chain_lengths(centers, box_friends[1] / 2)
+        if integral is not None:
+            candidates['live_pixels'], candidates['kill_pixels'] = box_counts(*integral, centers,
+                                                                              [box_friends, box_enemies])
+            candidates['density'] = box_density(candidates['live_pixels'], candidates['kill_pixels'], size)
+        if field is not None:
+            candidates['angle'], candidates['coherence'] = orientation_at(field, centers)
+            candidates['verticality'] = verticality(candidates['angle'], candidates['coherence'])
+    if by == 'density':
+        if integral is None:
+            raise ValueError("ranking by density needs the vein integral")
+        order = np.argsort(-candidates['density'], kind='stable')[:k]
+    elif by == 'orientation':
+        if field is None:
+            raise ValueError("ranking by orientation needs the orientation field")
+        order = np.argsort(-candidates['verticality'], kind='stable')[:k]
+    else:
+        order = np.argsort(-candidates['npoints'], kind='stable')[:k]
+    return candidates, order
+
+
+def box_density(live_pixels, kill_pixels, size):
+    """
+    :param live_pixels: vein pixels in the friends box (see box_counts)
+    :param kill_pixels: vein pixels in the enemies box
+    :param size: size of image array (same as for final_selection)
+    :return: share of the friends box that is vein minus the share of the enemies box that is
+    """
+    box_friends, box_enemies = selection_boxes(size)
+    return (np.asarray(live_pixels) / (box_friends[0] * box_friends[1]) -
+            np.asarray(kill_pixels) / (box_enemies[0] * box_enemies[1]))
+
+
+def verticality(angle, coherence):
+    """
+    :param angle: vein angle from vertical in degrees (see orientation_at)
+    :param coherence: how clear that direction is, 0 to 1
+    :return: coherence * cos(angle)^2: 1 for a clean vertical vein, 0 for a horizontal one or no clear direction
+    """
+    return np.asarray(coherence) * np.cos(np.radians(angle))**2
+
 
-    return final_selection
+BOX_SCORE_DTYPE = [('npoints', np.int64), ('standev', np.float64), ('avgdist', np.float64),
+                   ('maxdist', np.float64)]
+
+
+def score_boxes(centers, live, kill):
+    """
+    :param centers: all the kmean points
+    :param live: box width and height for a valid point analysis (see check_box)
+    :param kill: box width and height for a point that needs to be executed by the guillotine
+    :return: structured array with check_box's npoints, standev, avgdist and maxdist for every point in centers
+
+    Same as [check_box(each, centers, live, kill) for each in centers] without the Python loops (and without
+    re-sorting for the x median every time): npoints is exact, the float stats match to rounding. The points get
+    sorted by x once, so each point only gets paired up with the points that can land in either of its boxes.
+    check_box walks the set in order and stops at the first point in the kill box after it has passed the point
+    itself (or an exact duplicate of it); the pairs past that cutoff get dropped. The sums are cumulative sums over
+    zero padded rows, so they add up in the same order check_box does, but calc_standev squares with pow() on numpy
+    scalars (not always the same last bit as x*x) and float32 centers stay float32 in there, so standev can be off
+    in the last place or so. final_selection only looks at npoints.
+    """
+    centers = np.asarray(centers)
+    scores = np.zeros(len(centers), dtype=BOX_SCORE_DTYPE)
+    if len(centers) == 0:
+        return scores
+    x, y = centers[:, 0], centers[:, 1]
+    n = len(centers)
+    xmedian = np.sort(x)[n // 2]
+
+    # every (i, j) pair where j is within the wider of the two boxes from i along x
+    half_width = max(live[0], kill[0]) / 2
+    by_x = np.argsort(x, kind='stable')
+    sorted_x = x[by_x]
+    lo = np.searchsorted(sorted_x, x - half_width, 'left')
+    hi = np.searchsorted(sorted_x, x + half_width, 'right')
+    counts = hi - lo
+    i = np.repeat(np.arange(n), counts)
+    j = by_x[np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)]
+    order = np.lexsort((j, i))  # check_box order: by candidate, then by position in the set
+    i, j = i[order], j[order]
+    xi, yi, xj, yj = x[i], y[i], x[j], y[j]
+
+    same = (xj == xi) & (yj == yi)
+    in_kill = ((xi - kill[0]/2 < xj) & (xj < xi + kill[0]/2) & (yi - kill[1]/2 < yj) & (yj < yi + kill[1]/2))
+    in_live = ((xi - live[0]/2 < xj) & (xj < xi + live[0]/2) & (yi - live[1]/2 < yj) & (yj < yi + live[1]/2) &
+               (xmedian - 500 < xj) & (xj < xmedian + 500))
+    # where each candidate's walk stops: first kill box point after the first copy of itself
+    first_same = np.full(n, n)
+    np.minimum.at(first_same, i[same], j[same])
+    stop = np.full(n, n)
+    breaks = ~same & in_kill & (j > first_same[i])
+    np.minimum.at(stop, i[breaks], j[breaks])
+    keep = in_live & (j < stop[i])
+    i, xj, yj = i[keep], xj[keep], yj[keep]
+
+    npoints = np.bincount(i, minlength=n)
+    scores['npoints'] = npoints
+    scores['standev'] = scores['avgdist'] = scores['maxdist'] = 10000
+    # lay the box members out as zero padded rows, one per candidate
+    width = max(int(npoints.max()), 2)
+    column = np.arange(len(i)) - np.repeat(np.cumsum(npoints) - npoints, npoints)
+    bros_x = np.zeros((n, width))
+    bros_x[i, column] = xj
+    bros_y = np.full((n, width), np.finfo(np.float64).max)  # padding sorts last
+    bros_y[i, column] = yj
+    valid = np.arange(width) < npoints[:, None]
+    scored = npoints > 1
+
+    # calc_standev
+    mean_x = np.cumsum(bros_x, axis=1)[:, -1] / np.maximum(npoints, 1)
+    deviation = np.where(valid, (bros_x - mean_x[:, None])**2, 0)
+    standev = np.sqrt(np.cumsum(deviation, axis=1)[:, -1] / np.maximum(npoints - 1, 1))
+    # sort_and_compare, maxdist is the last gap that isn't zero
+    sorted_y = np.sort(bros_y, axis=1)
+    gaps = np.abs(np.diff(sorted_y, axis=1))
+    gap_valid = np.arange(width - 1) < (npoints - 1)[:, None]
+    gaps = np.where(gap_valid, gaps, 0)
+    avgdist = np.cumsum(gaps, axis=1)[:, -1] / np.maximum(npoints - 1, 1)
+    positive = gaps > 0
+    last_positive = width - 2 - np.argmax(positive[:, ::-1], axis=1)
+    maxdist = np.where(positive.any(axis=1), gaps[np.arange(n), last_positive], 0)
+
+    scores['standev'][scored] = standev[scored]
+    scores['avgdist'][scored] = avgdist[scored]
+    scores['maxdist'][scored] = maxdist[scored]
+    return scores
 
 
 def create_kmedoids(kmean_set, n):
@@ -242,6 +749,9 @@ def slope_chain(kpoint, kset, max_dist, slope, n):
     has reached a point where no points can fulfill the requirements at the end. If a chain
     reaches a certain length, it will be given a priority in the final selection since any
     set of points that meet this chain requirements are representative of a vein and not noise.
+
+    Careful: nothing stops this from walking back and forth between the same points, so it blows up on anything
+    but a handful of points. chain_lengths does the same job for every point at once.
     '''
     n_chain = n
     hold_slope = slope
@@ -261,7 +771,80 @@ def get_distance(kpoint, setpoint):
     :param setpoint: a different point
     :return: absolute distance between the two points
     '''
-    return abs(math.sqrt((kpoint[0]**2 - setpoint[0]**2) + (kpoint[1]**2 - setpoint[1]**2)))
+    return math.sqrt((kpoint[0] - setpoint[0])**2 + (kpoint[1] - setpoint[1])**2)
+
+
+def chain_lengths(kset, max_dist, tolerance=15.0):
+    """
+    :param kset: all the kmean points
+    :param max_dist: how far apart two neighbouring points in a chain can be
+    :param tolerance: how much (in degrees) the direction can change from one step of a chain to the next
+    :return: for every point, the number of points in the longest chain running through it
+
+    What slope_chain was going for: a chain is a run of points, each within max_dist of the last, where the
+    direction barely changes from step to step, which is what a vein looks like and noise doesn't. Chains are
+    followed down the image (increasing y, then x for ties) so there are no loops, and the direction of a step is
+    its angle from vertical, so vertical steps don't need capping like get_slope does.
+
+    Neighbours come from a KD tree. Every edge of the neighbour graph then gets the longest chain that starts with
+    it (working up from the bottom of the image) and the longest one that ends with it (working down), each edge
+    only looking at the edges that touch it, so it's roughly linear in the number of edges. A point's chain is the
+    best chain ending at it joined with the best compatible one starting there.
+    """
+    kset = np.asarray(kset, dtype=np.float64)
+    n = len(kset)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    rank = np.empty(n, dtype=np.int64)
+    rank[np.lexsort((kset[:, 0], kset[:, 1]))] = np.arange(n)
+    pairs = scipy.spatial.cKDTree(kset).query_pairs(max_dist, output_type='ndarray')
+    if len(pairs) == 0:
+        return np.ones(n, dtype=np.int64)
+    # point every edge down the image
+    flip = rank[pairs[:, 0]] > rank[pairs[:, 1]]
+    pairs[flip] = pairs[flip][:, ::-1]
+    src, dst = pairs[:, 0], pairs[:, 1]
+    step = kset[dst] - kset[src]
+    angle = np.degrees(np.arctan2(step[:, 0], step[:, 1]))
+    out_edges = [[] for _ in range(n)]
+    in_edges = [[] for _ in range(n)]
+    for e, (a, b) in enumerate(pairs):
+        out_edges[a].append(e)
+        in_edges[b].append(e)
+    out_edges = [np.array(edges, dtype=np.int64) for edges in out_edges]
+    in_edges = [np.array(edges, dtype=np.int64) for edges in in_edges]
+
+    def best_compatible(edge_angles, next_edges, lengths):
+        # longest chain among next_edges for each edge, only counting the ones that keep the direction
+        if len(next_edges) == 0:
+            return np.zeros(len(edge_angles), dtype=np.int64)
+        fits = np.abs(edge_angles[:, None] - angle[next_edges][None, :]) <= tolerance
+        return np.where(fits, lengths[next_edges][None, :], 0).max(axis=1)
+
+    # points in the longest chain starting with / ending with each edge
+    down = np.zeros(len(pairs), dtype=np.int64)
+    up = np.zeros(len(pairs), dtype=np.int64)
+    by_rank = np.argsort(rank)
+    for a in by_rank[::-1]:
+        for e in out_edges[a]:
+            down[e] = 1 + max(best_compatible(angle[[e]], out_edges[dst[e]], down)[0], 1)
+    for b in by_rank:
+        for e in in_edges[b]:
+            up[e] = 1 + max(best_compatible(angle[[e]], in_edges[src[e]], up)[0], 1)
+
+    chains = np.ones(n, dtype=np.int64)
+    for v in range(n):
+        ins, outs = in_edges[v], out_edges[v]
+        if len(outs):
+            chains[v] = max(chains[v], down[outs].max())
+        if len(ins):
+            chains[v] = max(chains[v], up[ins].max())
+        if len(ins) and len(outs):
+            fits = np.abs(angle[ins][:, None] - angle[outs][None, :]) <= tolerance
+            if fits.any():
+                # v is in both, don't count it twice
+                chains[v] = max(chains[v], (up[ins][:, None] + down[outs][None, :] - 1)[fits].max())
+    return chains
 
 
 def get_slope(kpoint, setpoint):
@@ -357,6 +940,40 @@ def adapt_thresh(img, max_val, block_sz, c):
     return result_img
 
 
+def bandpass_thresh(clahe_img, mask_img, block_sz, c_low, c_high, mask_t=100, dst=None, scratch=None):
+    """
+    Fused version of the adapt_thresh -> create_mask -> apply_mask bandpass chain.
+    :param clahe_img: image with CLAHE applied
+    :param mask_img: image used to create the arm mask (the raw camera image)
+    :param block_sz: the area of pixels to calculate each threshold for
+    :param c_low: constant for the low band (the one that actually ends up as veins)
+    :param c_high: constant for the high band
+    :param mask_t: threshold value used for the arm mask
+    :param dst: optional uint8 array to write the result into
+    :param scratch: optional tuple of three uint8 arrays (mean, arm mask, high band) the size of the image
+    :return: uint8 image, 0 on the veins and 254 (or 255 where only the high band passed) everywhere else
+
+    This returns exactly what masked_low - np.logical_and(masked_low, masked_high) used to. Both adaptive
+    thresholds share the same local mean, so we only compute it once: a pixel is black in adapt_thresh when it
+    sits at least c below the (rounded) mean, which is the same as cv2.subtract(mean, img) >= c. Everything stays
+    uint8 so we never build the full frame int64 arrays that apply_mask does.
+    """
+    depth_buf, arm_buf, high_buf = scratch if scratch is not None else (None, None, None)
+    depth = cv2.boxFilter(clahe_img, -1, (block_sz, block_sz), dst=depth_buf, normalize=True,
+                          borderType=cv2.BORDER_REPLICATE | cv2.BORDER_ISOLATED)
+    cv2.subtract(depth, clahe_img, dst=depth)  # how far below the local mean each pixel is
+    _, arm = cv2.threshold(mask_img, mask_t, 255, cv2.THRESH_BINARY, dst=arm_buf)
+    masked = cv2.compare(depth, c_low, cv2.CMP_GE, dst=dst)
+    high = cv2.compare(depth, c_high, cv2.CMP_GE, dst=high_buf)
+    cv2.bitwise_and(masked, arm, dst=masked)
+    cv2.bitwise_and(high, arm, dst=high)
+    # 255 everywhere but the masked low band, then knock off 1 wherever the high band did not fire
+    cv2.bitwise_not(masked, dst=masked)
+    cv2.bitwise_not(high, dst=high)
+    cv2.subtract(masked, 1, dst=masked, mask=high)
+    return masked
+
+
 def apply_mask(img, mask_in):
     """
     Apply a binary mask to an image
@@ -364,13 +981,10 @@ def apply_mask(img, mask_in):
     :param mask_in: A binary mask represented by a NumPy array
     :return: The masked image
     """
-    # Replace all black pixels in the image with a value that is neither black nor white
-    temp = np.where(img < 1, 127, 0)
-    # And the image with the mask.  The background of the image is completely black except
-    # where the veins are
-    temp_mask = cv2.bitwise_and(temp, temp, mask=mask_in)
-    # Replace all black pixels with white pixels, and all other pixels with black pixels
-    masked = np.where(temp_mask < 1, 255, 0)
+    # Black pixels stay black and everything else goes white...
+    masked = cv2.compare(img, 1, cv2.CMP_GE)
+    # ...and everything outside of the mask goes white too, so only the veins inside the mask are left black
+    cv2.bitwise_or(masked, 255, dst=masked, mask=cv2.compare(np.asarray(mask_in, dtype=np.uint8), 0, cv2.CMP_EQ))
     return masked
 
 
@@ -411,7 +1025,7 @@ def get_xmedian(points):
 
 def create_strips(image):
     """
-    :return: image with horizontal areas removed (so 0's) and the rest 1's
+    :return: image with horizontal areas removed (so 0's) and the rest 1's (uint8)
 
     Idea: if we remove segments of the vein data properly, we can force the kmean to
     be faster because the data will resemble more traditional kmean problems. In essence,
@@ -419,32 +1033,60 @@ def create_strips(image):
     """
     #  determine the image size
     [xsize, ysize] = np.shape(image)
-    slice_size = 100
+    return np.repeat(strip_rows(xsize, ysize), ysize, axis=1)
+
+
+def strip_rows(xsize, ysize, slice_size=100):
+    """
+    :param xsize: number of rows in the image
+    :param ysize: number of columns in the image
+    :param slice_size: height of each strip
+    :return: xsize x 1 uint8 column, the strips from create_strips for one column. Every column is the same so this
+             broadcasts against the image without building the full size mask.
+    """
     increment, remainder = ysize//slice_size,  ysize % slice_size
-    horizontal = np.ones((xsize, ysize))
+    horizontal = np.ones((xsize, 1), dtype=np.uint8)
     # divide into size 150 segments; may change this as needed
     k = 0
     while k < (increment):
         if k % 2 == 0:
-            horizontal[k*100:(k+1)*100, :] = 0
+            horizontal[k*slice_size:(k+1)*slice_size, :] = 0
         k = k + 1
 
     return horizontal
 
 
-def grid_mask(grid_vertical, enable_gantry_rails=True):
+def pack_mask(mask):
     """
-    :return: image with the gantry rails auto removed
+    :param mask: binary mask (anything nonzero counts as set)
+    :return: the mask packed down to 1 bit per pixel and its shape, for masks that get stored or cached
+    """
+    return np.packbits(np.asarray(mask, dtype=bool), axis=None), np.shape(mask)
+
+
+def unpack_mask(packed):
+    """
+    :param packed: (bits, shape) from pack_mask
+    :return: the mask as a 0/1 uint8 array
+    """
+    bits, shape = packed
+    return np.unpackbits(bits, count=int(np.prod(shape))).reshape(shape)
+
+
+def workspace_bounds(grid_vertical, enable_gantry_rails=True, extent=None):
+    """
+    :param extent: the grid's grid_extent if it is already known (e.g. from a GridModel), grid_vertical isn't
+                   looked at then
+    :return: (min_y, max_y, min_x, max_x) of the workspace; grid_mask keeps rows min_y:max_y and
+             columns min_x:max_x
 
     REQUIRES THE GRID "SPOOKY" LIBRARY spooky_lib.py
-    We are going to now mask the image based on the farthest left/right and farthest top/bottom
-    positions of the grids.
+    The workspace is bounded by the farthest left/right and farthest top/bottom positions of the grids.
     """
     #  To start, find the points that == 0
-    sizey, sizex = np.shape(grid_vertical)
-    points = np.where(grid_vertical < 0.5)
-    min_y, max_y = min(points[0]), max(points[0])
-    min_x, max_x = min(points[1]), max(points[1])
+    if extent is None:
+        extent = grid.grid_extent(grid_vertical)
+    min_y, max_y, min_x, max_x = extent
     #  I want to add more clearance here on the xaxis
     #  Also I am adding logic here to ensure that the gantry rails are eliminated. Take
     #  the x size and divide it by 2 and multiply by 0.222 and +/- that on both ends
@@ -452,7 +1094,24 @@ def grid_mask(grid_vertical, enable_gantry_rails=True):
     if enable_gantry_rails:  # in case Rich comes thru and crops the entire image ( ͡° ͜ʖ ͡°)
         min_x = min_x + 133#760#100#
         max_x = max_x - 200#880#100#
-    gantry_mask = np.ones((sizey, sizex))
+    return min_y, max_y, min_x, max_x
+
+
+def grid_mask(grid_vertical, enable_gantry_rails=True, bounds=None, shape=None):
+    """
+    :param bounds: workspace bounds if they are already known (skips scanning the grid)
+    :param shape: shape of the mask, for when there's no grid_vertical (bounds are needed then)
+    :return: image with the gantry rails auto removed
+
+    REQUIRES THE GRID "SPOOKY" LIBRARY spooky_lib.py
+    We are going to now mask the image based on the farthest left/right and farthest top/bottom
+    positions of the grids (see workspace_bounds).
+    """
+    sizey, sizex = np.shape(grid_vertical) if shape is None else shape[:2]
+    if bounds is None:
+        bounds = workspace_bounds(grid_vertical, enable_gantry_rails)
+    min_y, max_y, min_x, max_x = bounds
+    gantry_mask = np.ones((sizey, sizex), dtype=np.uint8)
     gantry_mask[:, 0:min_x] = 0
     gantry_mask[:, max_x:sizex] = 0
     gantry_mask[0:min_y, :] = 0
@@ -461,26 +1120,773 @@ def grid_mask(grid_vertical, enable_gantry_rails=True):
     return gantry_mask
 
 
-def execute_kmean(dataset, nclusters):
+class MaskCache:
+    """
+    Small LRU cache for the masks that only depend on the frame shape and the grid calibration: the gantry mask
+    (and workspace bounds) from grid_mask and the strips from create_strips. Without it every get_centers and
+    isolate_needle call scans the whole grid image again. Full frame masks are kept packed (see pack_mask).
+
+    Entries are keyed by shape, grid_id, rails flag and strip size. grid_id is whatever the owner uses to tell grid
+    calibrations apart; call clear() when the grid assets are reloaded. When the grid extent is known without the
+    grid image (see set_extent), pass None for grid_vertical and the frame shape instead.
+    """
+
+    def __init__(self, maxsize=4):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.extents = {}
+
+    def clear(self):
+        self.entries.clear()
+        self.extents.clear()
+
+    def set_extent(self, grid_id, extent):
+        """
+        :param grid_id: grid calibration the extent belongs to
+        :param extent: function taking the frame shape and returning the grid_extent at that resolution (e.g.
+                       GridModel.extent_at), used instead of scanning the grid image
+        """
+        self.extents[grid_id] = extent
+
+    def _get(self, key, build):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        value = build()
+        self.entries[key] = value
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return value
+
+    def _grid_entry(self, grid_vertical, grid_id, enable_gantry_rails, shape=None):
+        shape = np.shape(grid_vertical) if grid_vertical is not None else tuple(shape[:2])
+
+        def build():
+            extent = self.extents[grid_id](shape) if grid_id in self.extents else None
+            bounds = workspace_bounds(grid_vertical, enable_gantry_rails, extent)
+            return pack_mask(grid_mask(grid_vertical, enable_gantry_rails, bounds, shape)), bounds
+        return self._get(('grid_mask', shape, grid_id, enable_gantry_rails), build)
+
+    def grid_mask_packed(self, grid_vertical, grid_id, enable_gantry_rails=True, shape=None):
+        """
+        :return: packed gantry mask, same as pack_mask(grid_mask(grid_vertical, enable_gantry_rails))
+        """
+        return self._grid_entry(grid_vertical, grid_id, enable_gantry_rails, shape)[0]
+
+    def grid_mask(self, grid_vertical, grid_id, enable_gantry_rails=True, shape=None):
+        """
+        :return: same as grid_mask(grid_vertical, enable_gantry_rails)
+        """
+        return unpack_mask(self.grid_mask_packed(grid_vertical, grid_id, enable_gantry_rails, shape))
+
+    def workspace_bounds(self, grid_vertical, grid_id, enable_gantry_rails=True, shape=None):
+        """
+        :return: same as workspace_bounds(grid_vertical, enable_gantry_rails)
+        """
+        return self._grid_entry(grid_vertical, grid_id, enable_gantry_rails, shape)[1]
+
+    def strip_rows(self, shape, slice_size=100):
+        """
+        :return: same as strip_rows(shape[0], shape[1], slice_size)
+        """
+        return self._get(('strips', tuple(shape[:2]), slice_size),
+                         lambda: strip_rows(shape[0], shape[1], slice_size))
+
+
+def mean_center_distance(points, centers, sample=2000):
+    """
+    :param points: Nx2 array of points
+    :param centers: kmean centers
+    :param sample: at most about this many points get looked at (evenly spaced through the array)
+    :return: average distance from a point to its closest center
+    """
+    points = points[::max(len(points) // sample, 1)]
+    dist = np.linalg.norm(points[:, None, :] - np.asarray(centers)[None, :, :], axis=2)
+    return dist.min(axis=1).mean()
+
+
+class WarmStart:
+    """
+    Keeps the kmean centers of the last capture (per strip set) so the next one can start from them instead of
+    kmeans++. The arm barely moves between captures so the old centers are usually close to where the new ones end
+    up and the kmean only needs a few iterations.
+
+    To tell whether the veins are still roughly where they were, the new points get compared against the old
+    centers: if their average distance to the closest one is more than tolerance times what it was right after
+    the old fit, something moved and that strip set starts cold. A different image shape always starts cold.
+    """
+
+    def __init__(self, tolerance=1.5, sample=2000):
+        self.tolerance = tolerance
+        self.sample = sample
+        self.clear()
+
+    def clear(self):
+        self.shape = None
+        self.centers = [None, None]
+        self.fit_distance = [None, None]
+
+    def init_for(self, shape, which, points):
+        """
+        :param shape: shape of the image the points came from
+        :param which: strip set, 0 or 1
+        :param points: this capture's points for that strip set
+        :return: centers to start the kmean from, or None for a cold start
+        """
+        if self.shape != tuple(shape[:2]) or self.centers[which] is None or len(points) == 0:
+            return None
+        drift = mean_center_distance(points, self.centers[which], self.sample)
+        if drift > self.tolerance * self.fit_distance[which]:
+            return None
+        return self.centers[which]
+
+    def update(self, shape, which, points, centers):
+        """
+        Store the centers a strip set ended up with for the next capture.
+        """
+        if self.shape != tuple(shape[:2]):
+            self.clear()
+            self.shape = tuple(shape[:2])
+        self.centers[which] = np.array(centers)
+        self.fit_distance[which] = mean_center_distance(points, centers, self.sample)
+
+
+def clahe_tiles(shape, grid_size):
+    """
+    :param shape: (height, width) of the image
+    :param grid_size: CLAHE tile grid size (across, down)
+    :return: tile height, tile width and the padded height and width OpenCV's CLAHE works on
+    When the image doesn't divide into the tiles, OpenCV pads the bottom and right edges by the number of tiles
+    minus the remainder (in both directions, even if only one of them doesn't divide).
+    """
+    height, width = shape[:2]
+    if height % grid_size[1] or width % grid_size[0]:
+        height += grid_size[1] - height % grid_size[1]
+        width += grid_size[0] - width % grid_size[0]
+    return height // grid_size[1], width // grid_size[0], height, width
+
+
+def apply_clahe_window(img, clip_lim, grid_size, area):
+    """
+    :param img: full frame image
+    :param clip_lim: same as for apply_clahe
+    :param grid_size: same as for apply_clahe
+    :param area: (y0, y1, x0, x1) of the part of the result wanted
+    :return: apply_clahe(img, clip_lim, grid_size)[y0:y1, x0:x1], exactly, but only the tiles the area interpolates
+             between get median blurred and equalized
+
+    Same steps as OpenCV's CLAHE, done by hand for just those tiles: the tile histograms clipped and the excess
+    handed back out the same way, the lookup tables rounded from the same float32 products, and every pixel
+    interpolated between its four tiles from its position in the whole frame, in float32 and in the same order.
+    Tiles past the bottom/right edge (when the frame doesn't divide into the tiles) get the same reflected padding.
+    """
+    y0, y1, x0, x1 = area
+    height, width = np.shape(img)[:2]
+    tile_h, tile_w, _, _ = clahe_tiles(np.shape(img), grid_size)
+
+    def interpolation(start, stop, tile, ntiles):
+        # the two tiles every row/column interpolates between and its weight on the second
+        pos = np.arange(start, stop, dtype=np.float32) * (np.float32(1) / np.float32(tile)) - np.float32(0.5)
+        first = np.floor(pos)
+        weight = pos - first
+        first = first.astype(np.intp)
+        return np.maximum(first, 0), np.minimum(first + 1, ntiles - 1), weight
+    ty1, ty2, ya = interpolation(y0, y1, tile_h, grid_size[1])
+    tx1, tx2, xa = interpolation(x0, x1, tile_w, grid_size[0])
+    top, left = ty1[0], tx1[0]
+    ntiles_y, ntiles_x = ty2[-1] - top + 1, tx2[-1] - left + 1
+    ry0, ry1, rx0, rx1 = top * tile_h, (top + ntiles_y) * tile_h, left * tile_w, (left + ntiles_x) * tile_w
+
+    # median blur those tiles with 2 px of context; padding past the edge reflects the rows/columns before it
+    by0 = min(ry0, max(2 * height - ry1 - 1, 0)) if ry1 > height else ry0
+    bx0 = min(rx0, max(2 * width - rx1 - 1, 0)) if rx1 > width else rx0
+    cy0, cy1, cx0, cx1 = max(by0 - 2, 0), min(ry1 + 2, height), max(bx0 - 2, 0), min(rx1 + 2, width)
+    blur = cv2.medianBlur(np.ascontiguousarray(img[cy0:cy1, cx0:cx1]), 5)
+    blur = blur[by0 - cy0:min(ry1, height) - cy0, bx0 - cx0:min(rx1, width) - cx0]
+    if ry1 > height or rx1 > width:
+        blur = np.pad(blur, ((0, max(ry1 - height, 0)), (0, max(rx1 - width, 0))), mode='reflect')
+    blur = blur[ry0 - by0:, rx0 - bx0:]
+
+    tile_total = tile_h * tile_w
+    clip = max(int(clip_lim * tile_total / 256), 1)
+    lut_scale = np.float32(255) / np.float32(tile_total)
+    luts = np.empty((ntiles_y, ntiles_x, 256), dtype=np.float32)
+    for ty in range(ntiles_y):
+        for tx in range(ntiles_x):
+            tile = blur[ty * tile_h:(ty + 1) * tile_h, tx * tile_w:(tx + 1) * tile_w]
+            hist = np.bincount(tile.ravel(), minlength=256)
+            clipped = int(np.maximum(hist - clip, 0).sum())
+            np.minimum(hist, clip, out=hist)
+            hist += clipped // 256
+            residual = clipped % 256
+            if residual:
+                hist[::max(256 // residual, 1)][:residual] += 1
+            luts[ty, tx] = np.clip(np.rint(np.cumsum(hist).astype(np.float32) * lut_scale), 0, 255)
+
+    values = blur[y0 - ry0:y1 - ry0, x0 - rx0:x1 - rx0]
+    ty1, ty2, tx1, tx2 = ty1[:, None] - top, ty2[:, None] - top, tx1 - left, tx2 - left
+    ya, ya1 = ya[:, None], np.float32(1) - ya[:, None]
+    xa1 = np.float32(1) - xa
+    result = ((luts[ty1, tx1, values] * xa1 + luts[ty1, tx2, values] * xa) * ya1 +
+              (luts[ty2, tx1, values] * xa1 + luts[ty2, tx2, values] * xa) * ya)
+    return np.clip(np.rint(result), 0, 255).astype(np.uint8)
+
+
+class PreprocessPlan:
+    """
+    Everything the vein preprocessing needs for one resolution and parameter set, built once and reused.
+
+    apply_clahe used to make a new cv2.createCLAHE object every call and every stage allocated new full frame
+    arrays, and grid_mask/create_strips rebuilt their float64 masks on every capture. The plan owns the CLAHE
+    instance, the static masks and one buffer per stage so repeated captures do not allocate at all. Note that
+    the arrays handed back are the plan's buffers and get overwritten by the next capture; copy them if you
+    need to keep them around.
+
+    With workers > 1 the median blur and the bandpass thresholding run tiled over horizontal strips in a thread
+    pool (see run_tiled), each strip working in its own buffers (also made once, see strip_buffers). CLAHE stays a
+    single call on the whole frame: OpenCV already spreads it over its own threads, and equalizing strips
+    separately can't reproduce its interpolation bit for bit.
+
+    With crop=True only the workspace (the grid_mask rectangle, plus enough context around it for the CLAHE tiles
+    and the thresholding block) is processed; the rails and background are left blank in the output buffers and
+    process_selection_image only looks inside the rectangle. The work area runs from the top left corner to the
+    whole frame's CLAHE tile boundary one tile past the rectangle (plus the thresholding block) and gets the same
+    padding past the far edges, so every tile histogram and every interpolation inside the rectangle is the same as
+    on the whole frame and so is the result there. That work area is still about 80% of the frame (78-86% at the
+    GUI and camera resolutions), and the output images are blank past it, so don't crop images meant for display.
+    """
+
+    def __init__(self, shape, grid_vertical, enable_gantry_rails=True, clip_lim=7.0, grid_size=(40, 40),
+                 block_sz=127, c_low=15, c_high=20, mask_t=100, workers=1, crop=False, masks=None, grid_id=None):
+        """
+        :param shape: (height, width) of the images this plan will process
+        :param grid_vertical: processed vertical grid image used for the gantry mask (None when masks has the grid's
+                              extent, see MaskCache.set_extent)
+        :param enable_gantry_rails: whether or not to clip the gantry rails in the gantry mask
+        :param clip_lim: CLAHE clip limit
+        :param grid_size: CLAHE tile grid size
+        :param block_sz: adaptive thresholding block size
+        :param c_low: adaptive thresholding constant for the low band
+        :param c_high: adaptive thresholding constant for the high band
+        :param mask_t: threshold for the arm mask
+        :param workers: number of threads for the tiled stages; 1 runs everything on the calling thread
+        :param crop: only process the workspace rectangle
+        :param masks: optional MaskCache to get the gantry mask and strips from
+        :param grid_id: identifies grid_vertical in masks
+        """
+        self.shape = tuple(shape[:2])
+        self.key = PreprocessPlan.make_key(self.shape, enable_gantry_rails, clip_lim, grid_size, block_sz,
+                                           c_low, c_high, mask_t, workers, crop)
+        self.clip_lim, self.grid_size = clip_lim, grid_size
+        self.block_sz, self.c_low, self.c_high, self.mask_t = block_sz, c_low, c_high, mask_t
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+
+        # static masks, these only depend on the resolution and the grid
+        height, width = self.shape
+        if masks is None:
+            masks = MaskCache(maxsize=2)
+        self.mask_grid_packed = masks.grid_mask_packed(grid_vertical, grid_id, enable_gantry_rails, self.shape)
+        mask_grid = unpack_mask(self.mask_grid_packed)
+        # rows/columns of padding added past the bottom/right edge before CLAHE (only needed when cropping)
+        self.clahe_pad = (0, 0)
+        self.blur_area = (0, height, 0, width)
+        if crop:
+            min_y, max_y, min_x, max_x = masks.workspace_bounds(grid_vertical, grid_id, enable_gantry_rails,
+                                                                self.shape)
+            self.roi = (max(min_y, 0), max(max_y, min_y, 0), max(min_x, 0), max(max_x, min_x, 0))
+            y0, y1, x0, x1 = self.roi
+            if y1 > y0 and x1 > x0:
+                tile_h, tile_w, padded_h, padded_w = clahe_tiles(self.shape, grid_size)
+                # the thresholding block needs exact CLAHE past the roi, and the pixels in the last tile interpolate
+                # towards the next one, hence the extra tile. The work area always starts at the top left corner:
+                # CLAHE interpolates in float32 off the pixel coordinates, so shifting the origin changes the
+                # rounding of a few pixels
+                halo = block_sz // 2
+                ty1 = min(-(-(y1 + halo) // tile_h) + 1, grid_size[1])
+                tx1 = min(-(-(x1 + halo) // tile_w) + 1, grid_size[0])
+                self.work = (0, min(ty1 * tile_h, height), 0, min(tx1 * tile_w, width))
+                self.clahe_pad = (ty1 * tile_h - self.work[1], tx1 * tile_w - self.work[3])
+                grid_size = (tx1, ty1)
+                # the median blur needs its own context past the work area so the tile histograms come out right
+                self.blur_area = (0, min(self.work[1] + 2, height), 0, min(self.work[3] + 2, width))
+            else:
+                self.work = (0, height, 0, width)
+        else:
+            self.roi = (0, height, 0, width)
+            self.work = (0, height, 0, width)
+        self.clahe = cv2.createCLAHE(clipLimit=clip_lim, tileGridSize=grid_size)
+        y0, y1, x0, x1 = self.roi
+        # only the part of the gantry mask we look at on every capture is kept unpacked
+        self.roi_mask_grid = mask_grid[y0:y1, x0:x1].copy()
+        self.strips = masks.strip_rows(self.shape)[y0:y1]
+        self.strips_inv = 1 - self.strips
+
+        # stage buffers; outside of the work area these never get written so give them a blank background
+        self.blur = np.empty(self.shape, dtype=np.uint8)
+        self.clahe_img = np.zeros(self.shape, dtype=np.uint8)
+        self.masked = np.full(self.shape, 254, dtype=np.uint8)
+        work_shape = (self.work[1] - self.work[0], self.work[3] - self.work[2])
+        self.scratch = tuple(np.empty(work_shape, dtype=np.uint8) for _ in range(3))
+        if any(self.clahe_pad):
+            padded_shape = (work_shape[0] + self.clahe_pad[0], work_shape[1] + self.clahe_pad[1])
+            self.clahe_bufs = tuple(np.empty(padded_shape, dtype=np.uint8) for _ in range(2))
+        self.selection_bufs = tuple(np.empty((y1 - y0, x1 - x0), dtype=np.uint8) for _ in range(3))
+        if self.pool is not None:
+            # per strip output and scratch for the tiled stages: the blur's strips and the bandpass thresh's three
+            by0, by1, bx0, bx1 = self.blur_area
+            self.blur_strips = strip_buffers((by1 - by0, bx1 - bx0), workers, 5 // 2, 1)
+            self.thresh_strips = strip_buffers(work_shape, workers, block_sz // 2, 4)
+
+    @staticmethod
+    def make_key(shape, enable_gantry_rails=True, clip_lim=7.0, grid_size=(40, 40), block_sz=127, c_low=15,
+                 c_high=20, mask_t=100, workers=1, crop=False):
+        return (tuple(shape[:2]), enable_gantry_rails, clip_lim, tuple(grid_size), block_sz, c_low, c_high, mask_t,
+                workers, crop)
+
+    @property
+    def mask_grid(self):
+        """
+        :return: the full frame gantry mask (unpacked on request, 0/1 uint8)
+        """
+        return unpack_mask(self.mask_grid_packed)
+
+    def close(self):
+        """
+        Shut down the thread pool (if any). Call this when the plan is being replaced.
+        """
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+
+    def work_view(self, img):
+        """
+        :param img: full frame image
+        :return: view of the part of img the plan actually processes
+        """
+        y0, y1, x0, x1 = self.work
+        return img[y0:y1, x0:x1]
+
+    def apply_clahe(self, img):
+        """
+        Same as apply_clahe(img, clip_lim, grid_size) but written into the plan's buffers.
+        :param img: grayscale image the size of the plan
+        :return: the CLAHE image (plan buffer)
+        """
+        by0, by1, bx0, bx1 = self.blur_area
+        src, blur = img[by0:by1, bx0:bx1], self.blur[by0:by1, bx0:bx1]
+        if self.pool is None:
+            cv2.medianBlur(src, 5, dst=blur)
+        else:
+            run_tiled(lambda strip, out: cv2.medianBlur(strip, 5, dst=out), [src], blur, 5 // 2, self.pool,
+                      self.workers, self.blur_strips)
+        blur, out = self.work_view(self.blur), self.work_view(self.clahe_img)
+        if any(self.clahe_pad):
+            # the work area runs into the bottom/right edge: pad it the same way CLAHE pads the whole frame
+            padded, padded_out = self.clahe_bufs
+            cv2.copyMakeBorder(blur, 0, self.clahe_pad[0], 0, self.clahe_pad[1], cv2.BORDER_REFLECT_101, dst=padded)
+            self.clahe.apply(padded, dst=padded_out)
+            out[...] = padded_out[:out.shape[0], :out.shape[1]]
+        else:
+            self.clahe.apply(blur, dst=out)
+        return self.clahe_img
+
+    def apply_thresholding(self, img_in, clahe_img):
+        """
+        Same as bandpass_thresh with the plan's parameters but written into the plan's buffers.
+        :param img_in: raw image (used for the arm mask)
+        :param clahe_img: image with CLAHE applied
+        :return: thresholded image (plan buffer)
+        """
+        src, clahe_src, masked = self.work_view(img_in), self.work_view(clahe_img), self.work_view(self.masked)
+        if self.pool is None:
+            bandpass_thresh(clahe_src, src, self.block_sz, self.c_low, self.c_high, self.mask_t,
+                            dst=masked, scratch=self.scratch)
+        else:
+            def stage(clahe_strip, img_strip, out, *scratch):
+                bandpass_thresh(clahe_strip, img_strip, self.block_sz, self.c_low, self.c_high, self.mask_t,
+                                dst=out, scratch=scratch)
+            run_tiled(stage, [clahe_src, src], masked, self.block_sz // 2, self.pool, self.workers,
+                      self.thresh_strips)
+        return self.masked
+
+
+def split_strips(height, ntiles, halo):
+    """
+    :param height: number of rows in the image
+    :param ntiles: number of strips to split the image into
+    :param halo: rows of context each strip needs on either side
+    :return: list of (y0, y1, ey0, ey1); [y0, y1) are the rows the strip owns and [ey0, ey1) the rows it has to
+             read, i.e. the strip plus its halo clipped to the image
+    """
+    bounds = np.linspace(0, height, ntiles + 1).astype(int)
+    return [(y0, y1, max(y0 - halo, 0), min(y1 + halo, height)) for y0, y1 in zip(bounds[:-1], bounds[1:])
+            if y1 > y0]
+
+
+def strip_buffers(shape, ntiles, halo, count):
+    """
+    :param shape: (height, width) of the images run_tiled will get
+    :param ntiles: number of strips
+    :param halo: same as for run_tiled
+    :param count: buffers per strip
+    :return: list with a tuple of count uint8 arrays per strip, each the size of the strip plus its halo
+    """
+    return [tuple(np.empty((ey1 - ey0, shape[1]), dtype=np.uint8) for _ in range(count))
+            for _, _, ey0, ey1 in split_strips(shape[0], ntiles, halo)]
+
+
+def run_tiled(stage, srcs, dst, halo, pool, ntiles, bufs=None):
+    """
+    Run an image stage over overlapping horizontal strips in a thread pool and stitch the results into dst.
+    :param stage: function taking the strip (with halo) of every image in srcs and then the strip's buffers, and
+                  writing the processed strip into the first buffer (the rest are scratch for it)
+    :param srcs: list of full size input images
+    :param dst: full size output image
+    :param halo: half the largest window the stage uses (e.g. 2 for a 5x5 median)
+    :param pool: executor to run the strips on; OpenCV releases the GIL so threads are enough
+    :param ntiles: number of strips
+    :param bufs: per strip buffers from strip_buffers, kept around so repeated calls don't allocate; when None
+                 every strip gets a new output buffer (and no scratch)
+    :return: dst
+
+    As long as the halo covers the window, every pixel a strip owns sees exactly the neighbourhood it would see in
+    the whole image (the image edges still get OpenCV's border handling since those strips end at the real edge),
+    so the stitched result is identical to running the stage once on the whole frame.
+    """
+    strips = split_strips(np.shape(dst)[0], ntiles, halo)
+    if bufs is None:
+        bufs = strip_buffers(np.shape(dst), ntiles, halo, 1)
+
+    def work(strip, strip_bufs):
+        y0, y1, ey0, ey1 = strip
+        stage(*[src[ey0:ey1] for src in srcs], *strip_bufs)
+        dst[y0:y1] = strip_bufs[0][y0 - ey0:y1 - ey0]
+
+    list(pool.map(work, strips, bufs))
+    return dst
+
+
+def execute_kmean(dataset, nclusters, init=None):
     """
     :param dataset: valid vein points from image processing
     :param nclusters: number of clusters to generate
+    :param init: optional nclusters x 2 array of starting centers (otherwise kmeans++)
     :return: set of n number of cluster centers
     """
-    kmeans = MiniBatchKMeans(n_clusters=nclusters, random_state=0).fit(dataset)  # default is Kmeans++ so this function auto does that for us
+    if init is None:
+        kmeans = MiniBatchKMeans(n_clusters=nclusters, random_state=0).fit(dataset)  # default is Kmeans++ so this function auto does that for us
+    else:
+        kmeans = MiniBatchKMeans(n_clusters=nclusters, init=init, n_init=1, random_state=0).fit(dataset)
     return kmeans.cluster_centers_
 
 
+def strip_bands(points, ysize, slice_size=100):
+    """
+    :param points: Nx2 array of [x, y] points
+    :param ysize: number of columns in the image (strip_rows sizes its strips off this)
+    :param slice_size: height of each strip
+    :return: index of the strip from strip_rows every point falls in. Everything past the last full strip is one
+             band, same as in strip_rows.
+    """
+    return np.minimum(points[:, 1] // slice_size, ysize // slice_size)
+
+
+def band_budget(counts, nclusters):
+    """
+    :param counts: number of vein points in every band
+    :param nclusters: clusters to hand out
+    :return: clusters per band, proportional to the point counts (largest remainder) and never more than a band has
+             points
+    """
+    counts = np.asarray(counts)
+    if counts.sum() < nclusters:
+        raise ValueError("only {} vein points for {} clusters".format(counts.sum(), nclusters))
+    share = nclusters * counts / counts.sum()
+    budget = np.minimum(np.floor(share).astype(int), counts)
+    remainder = share - budget
+    while budget.sum() < nclusters:
+        remainder[budget >= counts] = -np.inf
+        i = np.argmax(remainder)
+        budget[i] += 1
+        remainder[i] -= 1
+    return budget
+
+
+def cluster_strip_bands(pic_array_1, pic_array_2, nclusters, ysize, pool, cell_size=None, slice_size=100,
+                        inits=(None, None)):
+    """
+    :param pic_array_1: points of the first strip set (from process_selection_image)
+    :param pic_array_2: points of the second strip set
+    :param nclusters: total number of clusters, half of them go to each strip set like in get_centers
+    :param ysize: number of columns in the image
+    :param pool: executor to run the jobs on (see make_cluster_pool)
+    :param cell_size: optional cell size for execute_kmean_binned
+    :param slice_size: height of each strip
+    :param inits: optional starting centers for each strip set (see WarmStart); a strip only uses the ones that
+                  fall inside it, and only if there are exactly as many as it gets clusters this time
+    :return: kmean centers, the first strip set's followed by the second's (same layout as get_centers)
+
+    The strips don't touch each other, so instead of one big kmean per strip set every strip is its own job, with
+    its share of the set's clusters going by how many vein points it has. All the jobs from both sets go to the pool
+    at once and the results get stitched back together in strip order.
+    """
+    jobs = []
+    for points, init in zip((pic_array_1, pic_array_2), inits):
+        bands = strip_bands(points, ysize, slice_size)
+        order = np.argsort(bands, kind='stable')  # stable so every band keeps the x then y point order
+        ids, starts, counts = np.unique(bands[order], return_index=True, return_counts=True)
+        budget = band_budget(counts, int(nclusters/2))
+        init_bands = strip_bands(init, ysize, slice_size) if init is not None else None
+        set_jobs = []
+        for band, start, count, k in zip(ids, starts, counts, budget):
+            if k == 0:
+                continue
+            band_points = points[order[start:start + count]]
+            band_init = init[init_bands == band] if init is not None else None
+            if band_init is not None and len(band_init) != k:
+                band_init = None
+            if cell_size:
+                set_jobs.append(pool.submit(execute_kmean_binned, band_points, int(k), cell_size, band_init))
+            else:
+                set_jobs.append(pool.submit(execute_kmean, band_points, int(k), band_init))
+        jobs.append(set_jobs)
+    centers_first, centers_second = (np.concatenate([job.result() for job in set_jobs]) for set_jobs in jobs)
+    return np.concatenate((centers_first, centers_second), axis=0)
+
+
+def _init_cluster_worker():
+    # every worker runs its own kmean, don't let them all spin up a full set of OpenMP/BLAS threads on top of that
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(1)
+
+
+def _warm_cluster_worker(seed):
+    # fit something tiny so the worker has sklearn and its thread pools loaded before the first real capture
+    return execute_kmean(np.random.RandomState(seed).rand(16, 2), 2)
+
+
+def make_cluster_pool(workers):
+    """
+    :param workers: number of worker processes
+    :return: a warmed up ProcessPoolExecutor for cluster_strip_bands. Keep it around between captures and shut it
+             down when done. Make it before starting any threads (e.g. a PreprocessPlan pool) since the workers
+             may get forked.
+    """
+    pool = ProcessPoolExecutor(workers, initializer=_init_cluster_worker)
+    list(pool.map(_warm_cluster_worker, range(workers)))
+    return pool
+
+
+def bin_points(dataset, cell_size):
+    """
+    :param dataset: Nx2 array of vein points
+    :param cell_size: size of the (square) cells in pixels
+    :return: centroid of the points in every occupied cell (Mx2 float) and how many points fell in it (M)
+    """
+    cells = dataset // cell_size
+    ncols = int(cells[:, 1].max()) + 1
+    index = cells[:, 0].astype(np.int64) * ncols + cells[:, 1]
+    counts = np.bincount(index)
+    occupied = np.nonzero(counts)[0]
+    sum_x = np.bincount(index, weights=dataset[:, 0])[occupied]
+    sum_y = np.bincount(index, weights=dataset[:, 1])[occupied]
+    counts = counts[occupied]
+    return np.column_stack((sum_x / counts, sum_y / counts)), counts
+
+
+def execute_kmean_binned(dataset, nclusters, cell_size=4, init=None):
+    """
+    :param dataset: valid vein points from image processing
+    :param nclusters: number of clusters to generate
+    :param cell_size: size of the cells the points get binned into
+    :param init: optional nclusters x 2 array of starting centers (otherwise kmeans++)
+    :return: set of n number of cluster centers
+
+    Same as execute_kmean, but instead of feeding every vein pixel in, the pixels get binned into cells first and the
+    kmean runs on the cell centroids weighted by how many pixels each one holds. The weighted problem has the same
+    optimum as the per pixel one (give or take the spread inside a cell), but its size depends on the area the veins
+    cover rather than the raw pixel count, which keeps growing with resolution and threshold noise.
+    """
+    centroids, counts = bin_points(dataset, cell_size)
+    if len(centroids) < nclusters:
+        return execute_kmean(dataset, nclusters, init)
+    if init is None:
+        kmeans = MiniBatchKMeans(n_clusters=nclusters, random_state=0)
+    else:
+        kmeans = MiniBatchKMeans(n_clusters=nclusters, init=init, n_init=1, random_state=0)
+    return kmeans.fit(centroids, sample_weight=counts).cluster_centers_
+
+
 def execute_DBSCAN(dataset, eps, min_samp):
     """
     :param dataset: points remaining after either the image processing or kmean step (haven't decided which yet)
     :param eps: epsilon value (we'll have to tweak this until it corresponds to veins and rejects shadow groups)
-    :param min_samples: not sure what this is yet
-    :return: unsure
+    :param min_samples: how many points (counting itself) need to be within eps of a point for it to be a core point
+    :return: fitted clustering with labels_ (-1 for noise) and core_sample_indices_, like sklearn's DBSCAN
+
+    Pixel coordinates (integers) go through GridDBSCAN, anything else (e.g. kmean centers) through sklearn.
     """
+    if np.issubdtype(np.asarray(dataset).dtype, np.integer):
+        return GridDBSCAN(eps, min_samp).fit(dataset)
     db = DBSCAN(eps=eps, min_samples = min_samp).fit(dataset)
     return db
 
+
+def _cell_pairs(starts_a, counts_a, starts_b, counts_b, max_pairs=1 << 22):
+    """
+    :return: generator over chunks of (pair, a, b): every combination of a point from cell a and one from cell b
+             for a list of cell pairs (points sorted by cell, so a cell is a start and a count), with the index of
+             the cell pair it came from. Chunks hold around max_pairs combinations.
+    """
+    sizes = counts_a * counts_b
+    ends = np.cumsum(sizes)
+    first = 0
+    while first < len(sizes):
+        last = max(np.searchsorted(ends, ends[first] - sizes[first] + max_pairs, 'right'), first + 1)
+        chunk = np.arange(first, last)
+        pair = np.repeat(chunk, sizes[chunk])
+        local = np.arange(len(pair)) - np.repeat(np.cumsum(sizes[chunk]) - sizes[chunk], sizes[chunk])
+        yield pair, starts_a[pair] + local // counts_b[pair], starts_b[pair] + local % counts_b[pair]
+        first = last
+
+
+class GridDBSCAN:
+    """
+    DBSCAN for integer pixel coordinates. Gives the same clusters as sklearn's DBSCAN (neighbours are the points
+    within eps including the point itself, core points have at least min_samples of them); only a border point
+    that is in reach of two clusters may end up in the other one, it goes to the closest core point here.
+
+    sklearn looks up the neighbours of every vein pixel one at a time, which takes seconds and lots of memory for a
+    whole frame. Here:
+    1) The neighbour counts are a convolution of the pixel occupancy grid with a disk of radius eps
+    2) Core points get hashed into square cells of side eps/sqrt(2), so all the core points in a cell are within
+        eps of each other and the cell can stand in for them
+    3) Neighbouring cells (up to two cells away) get joined if any pair of their core points is within eps, checked
+        with vectorized distances over all the cell pairs at once, closest cells first. Cells that are already in
+        the same cluster don't get checked again. The joins are a union-find (hooking plus pointer jumping)
+    4) The non core points get the label of the closest core point within eps, if there is one
+    Clusters are numbered in order of their first core point, the same as sklearn does it.
+    """
+
+    # neighbouring cells that can hold points within eps for a cell side of eps/sqrt(2), closest first
+    OFFSETS = [(1, 0), (0, 1), (1, 1), (-1, 1), (2, 0), (0, 2), (2, 1), (1, 2), (-2, 1), (-1, 2)]
+
+    def __init__(self, eps, min_samples=5):
+        self.eps = eps
+        self.min_samples = min_samples
+
+    def fit(self, X):
+        points = np.asarray(X)
+        if not np.issubdtype(points.dtype, np.integer):
+            raise ValueError("GridDBSCAN only takes integer (pixel) coordinates")
+        npoints = len(points)
+        self.labels_ = np.full(npoints, -1, dtype=np.int64)
+        self.core_sample_indices_ = np.empty(0, dtype=np.int64)
+        self.components_ = np.empty((0, 2), dtype=points.dtype)
+        if npoints == 0:
+            return self
+        points = (points - points.min(axis=0)).astype(np.int32)
+        eps2 = self.eps**2
+
+        # 1) neighbour counts
+        width, height = points.max(axis=0) + 1
+        occupancy = np.bincount(points[:, 1] * width + points[:, 0], minlength=width * height)
+        occupancy = occupancy.reshape(height, width).astype(np.float32)
+        r = int(np.floor(self.eps))
+        dy, dx = np.mgrid[-r:r + 1, -r:r + 1]
+        disk = (dx**2 + dy**2 <= eps2).astype(np.float32)
+        counts = cv2.filter2D(occupancy, cv2.CV_32F, disk, borderType=cv2.BORDER_CONSTANT)
+        counts = np.rint(counts[points[:, 1], points[:, 0]])
+        core = np.nonzero(counts >= self.min_samples)[0]
+        if len(core) == 0:
+            return self
+
+        # 2) hash the core points into cells
+        side = self.eps / np.sqrt(2)
+        cells = np.floor(points / side).astype(np.int64) + 2  # room for the offsets
+        ncols = cells[:, 1].max() + 3
+        key = cells[:, 0] * ncols + cells[:, 1]
+        core = core[np.argsort(key[core], kind='stable')]
+        cell_keys, cell_starts, cell_counts = np.unique(key[core], return_index=True, return_counts=True)
+        core_x, core_y = points[core, 0], points[core, 1]
+        parent = np.arange(len(cell_keys))
+
+        # 3) join neighbouring cells
+        for ox, oy in self.OFFSETS:
+            other = np.searchsorted(cell_keys, cell_keys + ox * ncols + oy)
+            other = np.minimum(other, len(cell_keys) - 1)
+            a = np.nonzero((cell_keys[other] == cell_keys + ox * ncols + oy))[0]
+            b = other[a]
+            keep = parent[a] != parent[b]
+            a, b = a[keep], b[keep]
+            if len(a) == 0:
+                continue
+            joined = np.zeros(len(a), dtype=bool)
+            for pair, u, v in _cell_pairs(cell_starts[a], cell_counts[a], cell_starts[b], cell_counts[b]):
+                step_x, step_y = core_x[u] - core_x[v], core_y[u] - core_y[v]
+                joined[pair[step_x * step_x + step_y * step_y <= eps2]] = True
+            parent = self._union(parent, a[joined], b[joined])
+
+        # number the clusters by their first core point
+        core_labels = parent[np.searchsorted(cell_keys, key[core])]
+        by_index = np.argsort(core)
+        _, first = np.unique(core_labels[by_index], return_index=True)
+        roots = core_labels[by_index][np.sort(first)]
+        renumber = np.empty(len(cell_keys), dtype=np.int64)
+        renumber[roots] = np.arange(len(roots))
+        self.labels_[core] = renumber[core_labels]
+
+        # 4) border points
+        border = np.nonzero(counts < self.min_samples)[0]
+        if len(border):
+            best_distance = np.full(len(border), np.inf)
+            best_core = np.zeros(len(border), dtype=np.int64)
+            for ox in range(-2, 3):
+                for oy in range(-2, 3):
+                    if abs(ox) == 2 and abs(oy) == 2:
+                        continue
+                    target = key[border] + ox * ncols + oy
+                    cell = np.minimum(np.searchsorted(cell_keys, target), len(cell_keys) - 1)
+                    a = np.nonzero(cell_keys[cell] == target)[0]
+                    b = cell[a]
+                    for pair, u, v in _cell_pairs(a, np.ones(len(a), dtype=np.int64), cell_starts[b], cell_counts[b]):
+                        step_x, step_y = points[border[u], 0] - core_x[v], points[border[u], 1] - core_y[v]
+                        distance = step_x * step_x + step_y * step_y
+                        better = distance <= np.minimum(best_distance[u], eps2)
+                        u, v, distance = u[better], v[better], distance[better]
+                        # closest one per border point in this chunk
+                        order = np.lexsort((distance, u))
+                        first = order[np.unique(u[order], return_index=True)[1]]
+                        best_distance[u[first]] = distance[first]
+                        best_core[u[first]] = v[first]
+            found = best_distance < np.inf
+            self.labels_[border[found]] = self.labels_[core[best_core[found]]]
+
+        self.core_sample_indices_ = np.sort(core)
+        self.components_ = np.asarray(X)[self.core_sample_indices_]
+        return self
+
+    @staticmethod
+    def _union(parent, a, b):
+        # hook the larger root under the smaller one until every edge is inside one tree, then flatten
+        while True:
+            root_a, root_b = parent[a], parent[b]
+            differ = root_a != root_b
+            if not differ.any():
+                return parent
+            low = np.minimum(root_a, root_b)[differ]
+            high = np.maximum(root_a, root_b)[differ]
+            np.minimum.at(parent, high, low)
+            while True:
+                jumped = parent[parent]
+                if (jumped == parent).all():
+                    break
+                parent = jumped
+
 def initialize_grids(image, file_horizontal, file_vertical, unused_arg=False):
     """
     :param image: photo taken by the pi camera
@@ -514,10 +1920,72 @@ def initialize_grids(target_res, np_horizontal, np_vertical):
     return grid_vertical, grid_horizontal
 
 
-def compare_points(iv_site, needle, grid_horizontal, grid_vertical):
+# bump whenever initialize_grids, process_grid or position_maps change what they produce
+CALIBRATION_CACHE_VERSION = 1
+CALIBRATION_FILES = ('grid_vertical', 'grid_horizontal', 'mm_x', 'mm_y', 'step_x', 'step_y')
+
+
+def load_calibration(target_res, file_horizontal, file_vertical, cache_dir=None):
     """
-    :param iv_site: injection site
-    :param needle: needle position
+    :param target_res: (rows, columns) of the camera images
+    :param file_horizontal: address of the horizontal grid asset
+    :param file_vertical: address of the vertical grid asset
+    :param cache_dir: directory to keep processed calibrations in (None to always process from scratch)
+    :return: grid_vertical, grid_horizontal (same as initialize_grids) and their spooky_lib.position_maps
+
+    Processing the grids and building the position maps takes a while and always comes out the same for the same
+    assets and resolution, so the results get saved as .npy files in cache_dir, in a directory named after a hash
+    of the asset files, the resolution, the processing parameters and CALIBRATION_CACHE_VERSION. Next time they're
+    memory mapped straight from there (read only), so nothing gets processed and every process using the same
+    calibration shares the same pages. The directory gets written under a temporary name and renamed once
+    complete, so a half written calibration never gets picked up.
+    """
+    with open(file_horizontal, 'rb') as f:
+        horizontal_bytes = f.read()
+    with open(file_vertical, 'rb') as f:
+        vertical_bytes = f.read()
+    key = hashlib.sha1()
+    key.update(repr((CALIBRATION_CACHE_VERSION, tuple(target_res), 'process_grid', 0.6)).encode())
+    key.update(hashlib.sha1(horizontal_bytes).digest())
+    key.update(hashlib.sha1(vertical_bytes).digest())
+    path = None if cache_dir is None else os.path.join(cache_dir, key.hexdigest())
+
+    if path is not None and os.path.isdir(path):
+        try:
+            arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in CALIBRATION_FILES]
+            return arrays[0], arrays[1], tuple(arrays[2:])
+        except (OSError, ValueError):
+            shutil.rmtree(path, ignore_errors=True)  # broken entry, just redo it
+
+    horizontal = cv2.imdecode(np.frombuffer(horizontal_bytes, np.uint8), 0)
+    vertical = cv2.imdecode(np.frombuffer(vertical_bytes, np.uint8), 0)
+    grid_vertical, grid_horizontal = initialize_grids(tuple(target_res), horizontal, vertical)
+    # the caller names these the other way around (see Processor.load_grids), keep the maps consistent with that
+    maps = grid.position_maps(grid_vertical, grid_horizontal)
+    if path is None:
+        return grid_vertical, grid_horizontal, maps
+
+    os.makedirs(cache_dir, exist_ok=True)
+    staging = tempfile.mkdtemp(dir=cache_dir)
+    for name, array in zip(CALIBRATION_FILES, (grid_vertical, grid_horizontal) + tuple(maps)):
+        np.save(os.path.join(staging, name + '.npy'), array)
+    try:
+        os.rename(staging, path)
+    except OSError:
+        shutil.rmtree(staging, ignore_errors=True)  # someone else got there first, or the old entry was broken
+        if not os.path.isdir(path):
+            return grid_vertical, grid_horizontal, maps
+    arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in CALIBRATION_FILES]
+    return arrays[0], arrays[1], tuple(arrays[2:])
+
+
+def compare_points(iv_site, needle, grid_horizontal, grid_vertical, maps=None, model=None, shape=None):
+    """
+    :param iv_site: injection site (or an Nx2 array of them)
+    :param needle: needle position (or an Nx2 array of them)
+    :param maps: optional position maps (see get_position)
+    :param model: optional fitted grid model (see get_position)
+    :param shape: image shape for the model (see get_position)
     :return: xy difference between them to pass to the Arduino (always relative to the injection site)
 
     This is the function that will be called during error checking to compare the position of
@@ -526,22 +1994,31 @@ def compare_points(iv_site, needle, grid_horizontal, grid_vertical):
     """
     # FUN FACT - YOU CANNOT DO THIS IN PIXEL COORDINATES UNDER ANY CONDITIONS! It will not work
     # with the grid logic. You always have to calculate the new heading using mm coordinates!
-    iv_mm = get_position(iv_site, grid_horizontal, grid_vertical)
-    needle_mm = get_position(needle, grid_horizontal, grid_vertical)
+    iv_mm = get_position(iv_site, grid_horizontal, grid_vertical, maps, model, shape)
+    needle_mm = get_position(needle, grid_horizontal, grid_vertical, maps, model, shape)
     # Also note that because I suck at keeping track of variables and dimensions, this
     # correction variable has the coordinates purposefully swapped
     correction = [iv_mm[1]-needle_mm[1], iv_mm[0]-needle_mm[0]]
     return correction
 
 
-def get_position(site, grid_horizontal, grid_vertical):
+def get_position(site, grid_horizontal, grid_vertical, maps=None, model=None, shape=None):
     """
     :param site: selected xy position on the image
     :param grid_horizontal: image array of the horizontal grid lines
     :param grid_vertical: image array of the vertical grid lines
+    :param maps: optional spooky_lib.position_maps of the grids; turns this into a lookup that also takes an Nx2
+                 array of sites
+    :param model: optional spooky_lib.GridModel; takes precedence over the maps, only the shape of grid_horizontal
+                  gets used then
+    :param shape: shape of the image the sites are in, for the model when there are no grid images
     :return: xy position in actual mm length (e.g. 55.2 mm over, 67.1 mm down)
     REQUIRES THE GRID LIBRARY "SPOOKY_LIB"
     """
+    if model is not None:
+        return model.lookup(site, np.shape(grid_horizontal) if shape is None else shape)
+    if maps is not None:
+        return grid.lookup_position(maps, site)
     xslice, yslice = grid.slice_grid(site, grid_horizontal, grid_vertical)
     [xpos, ypos] = grid.interpolate(site, yslice, xslice)
     return xpos, ypos
@@ -569,12 +2046,13 @@ def check_needle(updated_image, injection_site):
     """
 
 
-def isolate_needle(updated_image, grid_vertical, enable_gantry_rails=True):
+def isolate_needle(updated_image, grid_vertical, enable_gantry_rails=True, mask_grid=None):
     """
     :param updated_image: image with the needle in view of the camera
+    :param mask_grid: gantry mask if it is already known (e.g. from a MaskCache)
     :return: position of the needle tip in pixel coordinates (we want to keep this in pixels because the grid
-             library only takes its inputs as pixel coordinates and I really do not want to write a reciprocal
-             function for converting mm coordinates to xy pixel locations)
+             library mostly takes its inputs as pixel coordinates; going back from mm to pixels needs the fitted
+             spooky_lib.GridModel, see GridModel.inverse)
 
     This function will need an equivalent function "isolate_sharpie" for test purposes at the Senior Design Fair.
     Hopefully that only involves adjusting the threshold of the image processing taking place in this function.
@@ -583,7 +2061,8 @@ def isolate_needle(updated_image, grid_vertical, enable_gantry_rails=True):
     #  To isolate the needle in the image, let's use the same image processing for the veins but with a higher
     #  threshold value to remove the veins and any noise. If this is done properly (and like it was prototyped in
     #  MATLAB, we should have just a narrow black line remaining.
-    mask_grid = grid_mask(grid_vertical, enable_gantry_rails)
+    if mask_grid is None:
+        mask_grid = grid_mask(grid_vertical, enable_gantry_rails)
     image_points = process_needle_image(updated_image, mask_grid)
     #  With the isolated needle, extract the point at the lowest y position (average all the points x and y
     #  positions first just to make sure we are not pulling off noise (there's a high chance of that if we do not
@@ -608,9 +2087,51 @@ def find_needle_tip(image_points):
     return idx
 
 
-def process_needle_image(img_in, mask_grid):
+def lowest_pixel(needle):
+    """
+    :param needle: 0/1 needle image (e.g. from needle_mask)
+    :return: [x, y] of the lowest needle pixel (leftmost if there's a tie, same as find_needle_tip), None if empty
+
+    Only looks for the last row with anything in it instead of listing every needle pixel first.
+    """
+    rows = np.flatnonzero(needle.any(axis=1))
+    if len(rows) == 0:
+        return None
+    row = rows[-1]
+    return [int(np.argmax(needle[row])), int(row)]
+
+
+def needle_mask(img_in, mask_grid, clip_lim=5.0, grid_size=(8, 8), block_sz=153, c=97, area=None):
+    """
+    :param img_in: image taken by the Raspberry Pi camera
+    :param mask_grid: gantry mask the same size as img_in
+    :param area: optional (y0, y1, x0, x1) to only work out that part of the result (exactly the same pixels, see
+                 apply_clahe_window)
+    :return: 0/1 uint8 image of the needle pixels (the black ones inside the gantry mask)
+    """
+    mask_grid = np.asarray(mask_grid, dtype=np.uint8)
+    if area is None:
+        clahe_img = apply_clahe(img_in, clip_lim, grid_size)
+        adapt_mean_th = adapt_thresh(clahe_img, 255, block_sz, c)
+    else:
+        # the threshold's block needs the CLAHE image around the area as well (at the frame's edges it gets the
+        # same replicated border either way)
+        height, width = np.shape(img_in)[:2]
+        y0, y1, x0, x1 = area
+        half = block_sz // 2
+        cy0, cy1, cx0, cx1 = max(y0 - half, 0), min(y1 + half, height), max(x0 - half, 0), min(x1 + half, width)
+        clahe_img = apply_clahe_window(img_in, clip_lim, grid_size, (cy0, cy1, cx0, cx1))
+        adapt_mean_th = adapt_thresh(clahe_img, 255, block_sz, c)[y0 - cy0:y1 - cy0, x0 - cx0:x1 - cx0]
+        mask_grid = mask_grid[y0:y1, x0:x1]
+    needle = np.equal(adapt_mean_th, 0).view(np.uint8)
+    np.bitwise_and(needle, mask_grid, out=needle)
+    return needle
+
+
+def process_needle_image(img_in, mask_grid, show=False):
     """
     :param img_in: image taken by the Raspberry Pi camera
+    :param show: plot the needle pixels (blocks until the plot is closed)
     :return: the processed image POINTS that will be further analyzed (a 2xN numpy array)
 
     Algorithm Process is as follows:
@@ -620,24 +2141,100 @@ def process_needle_image(img_in, mask_grid):
     4) Apply the mask to the image created by (3)
     5) Extract the remaining points and return a 2xN numpy array
     """
-    clahe_img = apply_clahe(img_in, 5.0, (8, 8))
     threshold = int(0.6*255)
-    adapt_mean_th = adapt_thresh(clahe_img, 255, threshold, 97)
-    adapt_mean_th = np.logical_or(adapt_mean_th, adapt_mean_th)
-    image = (np.logical_and(mask_grid, adapt_mean_th)) + np.logical_not(mask_grid)
-    plt.plot
-    plt.imshow(image)
-    plt.show()
-    return np.where(image == 0)
+    needle = needle_mask(img_in, mask_grid, 5.0, (8, 8), threshold, 97)
+    if show:
+        plt.imshow(needle)
+        plt.show()
+    return np.where(needle)
+
+
+class NeedleTracker:
+    """
+    Follows the needle tip from frame to frame. The first frame (or whenever it loses the needle) gets processed
+    whole, same as isolate_needle; after that only a window around the last tip (or wherever the gantry was told
+    to go) goes through CLAHE and the adaptive threshold (see needle_mask's area).
+
+    The needle pixels in the window are exactly the ones the whole frame would give there, so on a frame that
+    hasn't changed update finds the same tip as acquire (short of a tie with a needle pixel further left in the
+    same row, outside the window). If there's nothing in the window, or the lowest needle pixel is on its bottom
+    edge (the needle carries on below it), that frame gets processed whole again.
+    """
+
+    def __init__(self, mask_grid, window=200, clip_lim=5.0, grid_size=(8, 8), block_sz=153, c=97):
+        """
+        :param mask_grid: gantry mask for the full frame
+        :param window: half size of the area searched for the tip around the last one, in pixels at 2464 rows (it
+                       gets scaled with the frame height)
+        """
+        self.mask_grid = np.asarray(mask_grid, dtype=np.uint8)
+        self.window = window
+        self.clip_lim = clip_lim
+        self.grid_size = grid_size
+        self.block_sz = block_sz
+        self.c = c
+        self.tip = None
+        # how many frames had to be processed whole, to keep an eye on how well the tracking holds
+        self.full_frames = 0
+
+    def reset(self):
+        self.tip = None
+
+    def acquire(self, image):
+        """
+        :param image: full camera frame
+        :return: [x, y] of the needle tip, None if there's no needle
+        """
+        self.full_frames += 1
+        needle = needle_mask(image, self.mask_grid, self.clip_lim, self.grid_size, self.block_sz, self.c)
+        self.tip = lowest_pixel(needle)
+        return self.tip
+
+    def update(self, image, hint=None):
+        """
+        :param image: full camera frame
+        :param hint: [x, y] pixel position to look around instead of the last tip (e.g. where the gantry was just
+                     sent, see Processor.get_pixels_from_mm)
+        :return: [x, y] of the needle tip, None if there's no needle
+        """
+        center = hint if hint is not None else self.tip
+        if center is None:
+            return self.acquire(image)
+        height, width = np.shape(image)[:2]
+        cx, cy = int(round(center[0])), int(round(center[1]))
+        # the area the tip is looked for in
+        window = max(int(round(self.window * height / 2464)), 1)
+        ix0, ix1 = max(cx - window, 0), min(cx + window + 1, width)
+        iy0, iy1 = max(cy - window, 0), min(cy + window + 1, height)
+        if ix1 <= ix0 or iy1 <= iy0:
+            return self.acquire(image)
+        needle = needle_mask(image, self.mask_grid, self.clip_lim, self.grid_size, self.block_sz, self.c,
+                             (iy0, iy1, ix0, ix1))
+        tip = lowest_pixel(needle)
+        if tip is None:
+            return self.acquire(image)
+        tip = [tip[0] + ix0, tip[1] + iy0]
+        # lowest pixel on the bottom edge: the needle carries on below the window
+        if tip[1] == iy1 - 1 and iy1 < height:
+            return self.acquire(image)
+        self.tip = tip
+        return self.tip
 
 
 def extract_points(img):
     """
     :param img: numpy array of processed image after thresholding and masking operations
-    :return: set of points that represent the veins
+    :return: set of points that represent the veins, as a contiguous Nx2 int32 array of [x, y]
+
+    The points come out sorted by x and then y (same order as always, kmean cares about the order). Building a
+    python tuple for every vein pixel and then turning the list back into an array was a big chunk of the time
+    before clustering, so this stays an array the whole way.
     """
-    img = np.transpose(img)
-    return list(zip(*np.where(img == 1)))
+    xs, ys = np.nonzero(np.transpose(img) == 1)
+    points = np.empty((len(xs), 2), dtype=np.int32)
+    points[:, 0] = xs
+    points[:, 1] = ys
+    return points
 
 
 def isolate_sharpie(img, mask_img, mask_t, adapt_t, c, grid_vertical, enable_gantry_rails):
@@ -664,8 +2261,8 @@ def isolate_sharpie(img, mask_img, mask_t, adapt_t, c, grid_vertical, enable_gan
 
     #  Apply the mask
     mask_grid = grid_mask(grid_vertical, enable_gantry_rails)
-    masked_img = apply_mask(adapt_mean_th, mask)
-    masked_img = (np.logical_and(mask_grid, masked_img)) + np.logical_not(mask_grid)
+    masked_img = np.not_equal(apply_mask(adapt_mean_th, mask), 0).view(np.uint8)
+    masked_img[mask_grid == 0] = 1
     plt.imshow(masked_img, 'gray')
 
     #  Extract the remaining points and remove any associated with the gantry rails
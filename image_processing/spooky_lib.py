@@ -11,6 +11,7 @@
 import image_processing.prostick_lib as iv
 import cv2
 import numpy as np
+import scipy.spatial
 
 
 def oh_no():
@@ -142,3 +143,283 @@ def slice_grid(xy, horizontal, vertical):
     return vertical[int(xy[1]), :], horizontal[:, int(xy[0])]
 
 
+def count_lines(grid_img):
+    """
+    :param grid_img: grid image array, the lines get counted going down every column (axis 0)
+    :return: float32 arrays the same shape as grid_img: what count_loop gives for every whole pixel position of
+             every column, and how much that changes per pixel in between (count_loop takes fractional positions
+             too, and its interpolation is linear in them)
+
+    This is count_loop for every column and every position at once. count_loop walks down the line counting the
+    grid lines it enters before the selected position (5 mm each), then interpolates across the whitespace right in
+    front of the grid line it stops at: the first one starting at or after the selection, or the last one if there
+    isn't one after it. With the starts and ends of the grid line runs marked, all of that is cumulative sums and
+    running min/max along the column.
+    """
+    line = np.asarray(grid_img) < 100
+    height = line.shape[0]
+    above = np.zeros_like(line)
+    above[1:] = line[:-1]
+    below = np.zeros_like(line)
+    below[:-1] = line[1:]
+    starts = line & ~above
+    ends = line & ~below
+    index = np.arange(height, dtype=np.int32)[:, None]
+    # grid lines entered before each position
+    count = np.zeros(line.shape, dtype=np.int32)
+    np.cumsum(starts[:-1], axis=0, out=count[1:])
+    # the grid line count_loop stops in front of
+    big = np.int32(height)
+    next_start = np.where(starts, index, big)
+    next_start = np.minimum.accumulate(next_start[::-1], axis=0)[::-1]
+    last_start = np.where(starts, index, -1).max(axis=0)
+    stop = np.where(next_start < big, next_start, last_start[None, :])
+    # the whitespace in front of it runs from just past the grid line before it to right before it
+    previous_end = np.where(ends, index, -1)
+    np.maximum.accumulate(previous_end, axis=0, out=previous_end)
+    previous_end = np.vstack((np.full((1, line.shape[1]), -1, dtype=previous_end.dtype), previous_end[:-1]))
+    white_previous = np.take_along_axis(previous_end, np.maximum(stop, 0), axis=0) + 1
+    white_final = stop - 1
+    has_white = (stop > 0) & (last_start[None, :] >= 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        step = np.where(has_white, -5 / (white_previous - white_final), 0)
+        value = np.where(has_white, 5 * count + 5 * (white_previous - index) / (white_previous - white_final),
+                         5 * count)
+    return value.astype(np.float32), step.astype(np.float32)
+
+
+def position_maps(grid_horizontal, grid_vertical):
+    """
+    :param grid_horizontal: horizontal grid line image array
+    :param grid_vertical: vertical grid line image array
+    :return: mm_x, mm_y, step_x, step_y: float32 maps of what get_position gives for every pixel, plus how much
+             each changes per pixel (for fractional positions). Build them once per grid calibration and hand them
+             to lookup_position.
+    """
+    mm_x, step_x = count_lines(grid_horizontal)
+    mm_y, step_y = count_lines(np.transpose(grid_vertical))
+    return mm_x, np.ascontiguousarray(mm_y.T), step_x, np.ascontiguousarray(step_y.T)
+
+
+def lookup_position(maps, sites):
+    """
+    :param maps: from position_maps
+    :param sites: an [x, y] position or an Nx2 array of them
+    :return: mm positions the same way get_position gives them (xpos from the horizontal grid going down, ypos from
+             the vertical grid going across), as two numbers or two arrays of N
+    Positions off the image raise an IndexError, same as slice_grid does past the far edges.
+    """
+    mm_x, mm_y, step_x, step_y = maps
+    points = np.asarray(sites, dtype=np.float64)
+    single = points.ndim == 1
+    points = points.reshape(-1, 2)
+    col = np.trunc(points[:, 0]).astype(np.intp)
+    row = np.trunc(points[:, 1]).astype(np.intp)
+    if np.any((col < 0) | (col >= mm_x.shape[1]) | (row < 0) | (row >= mm_x.shape[0])):
+        raise IndexError("site off the grid: {}".format(points[(col < 0) | (col >= mm_x.shape[1]) |
+                                                               (row < 0) | (row >= mm_x.shape[0])].tolist()))
+    xpos = mm_x[row, col] + step_x[row, col] * (points[:, 1] - row)
+    ypos = mm_y[row, col] + step_y[row, col] * (points[:, 0] - col)
+    if single:
+        return float(xpos[0]), float(ypos[0])
+    return xpos, ypos
+
+
+def grid_intersections(grid_horizontal, grid_vertical, maps):
+    """
+    :param grid_horizontal: horizontal grid line image array
+    :param grid_vertical: vertical grid line image array
+    :param maps: position_maps of the two grids
+    :return: Nx2 array of [x, y] pixel positions where a horizontal and a vertical grid line cross, and the Nx2
+             get_position style mm positions of those crossings (snapped to the 5 mm grid)
+    """
+    crossings = ((np.asarray(grid_horizontal) < 100) & (np.asarray(grid_vertical) < 100)).astype(np.uint8)
+    count, _, stats, centroids = cv2.connectedComponentsWithStats(crossings, connectivity=8)
+    # a couple of pixels of overlap where two lines cross; anything bigger or smaller is something else
+    area = stats[1:, cv2.CC_STAT_AREA]
+    typical = np.median(area) if len(area) else 0
+    keep = (area >= typical / 4) & (area <= typical * 4)
+    pixels = centroids[1:][keep]
+    xpos, ypos = lookup_position(maps, pixels)
+    mm = np.column_stack((5 * np.round(np.asarray(xpos) / 5), 5 * np.round(np.asarray(ypos) / 5)))
+    good = np.all(np.isfinite(mm), axis=1)
+    return pixels[good], mm[good]
+
+
+def lattice_indices(pixels):
+    """
+    :param pixels: Nx2 array of [x, y] grid line crossings
+    :return: Nx2 int array of the (row, column) of every crossing in the grid, counted from the one the walk starts
+             at, and a mask of the crossings that are connected to it (the rest get 0, 0)
+
+    Neighbouring crossings are one grid step apart, so this walks from crossing to crossing counting the steps.
+    Steps that aren't close to one grid step across or down (a missing crossing, a blob that isn't a crossing)
+    are not taken.
+    """
+    pixels = np.asarray(pixels, dtype=np.float64)
+    indices = np.zeros((len(pixels), 2), dtype=int)
+    found = np.zeros(len(pixels), dtype=bool)
+    if len(pixels) < 5:
+        return indices, found
+    _, neighbours = scipy.spatial.cKDTree(pixels).query(pixels, k=5)
+    offsets = pixels[neighbours[:, 1:]] - pixels[:, None]
+    flat = offsets.reshape(-1, 2)
+    across = flat[(np.abs(flat[:, 0]) > np.abs(flat[:, 1])) & (flat[:, 0] > 0)]
+    down = flat[(np.abs(flat[:, 1]) > np.abs(flat[:, 0])) & (flat[:, 1] > 0)]
+    if len(across) == 0 or len(down) == 0:
+        return indices, found
+    # neighbour offsets in grid steps (column, row)
+    steps = np.linalg.solve(np.column_stack((np.median(across, axis=0), np.median(down, axis=0))),
+                            flat.T).T.reshape(offsets.shape)
+    rounded = np.round(steps)
+    single = (np.all(np.abs(steps - rounded) < 0.25, axis=2) & (np.abs(rounded).sum(axis=2) == 1))
+
+    start = int(np.argmin(np.sum((pixels - np.median(pixels, axis=0))**2, axis=1)))
+    found[start] = True
+    queue = [start]
+    while queue:
+        i = queue.pop()
+        for k in np.nonzero(single[i])[0]:
+            j = neighbours[i, k + 1]
+            if not found[j]:
+                found[j] = True
+                indices[j] = indices[i] + rounded[i, k, ::-1].astype(int)
+                queue.append(j)
+    return indices, found
+
+
+def grid_extent(grid_img):
+    """
+    :param grid_img: processed grid image
+    :return: (min_y, max_y, min_x, max_x), the first and last row and column with a grid line pixel in them
+    """
+    rows, columns = np.where(grid_img < 0.5)
+    return rows.min(), rows.max(), columns.min(), columns.max()
+
+
+class GridModel:
+    """
+    Analytic pixel -> mm model of the grid: a homography plus a low order polynomial correction (lens distortion
+    and whatever else the homography can't bend to), fitted once to the grid line crossings. It gives the same
+    kind of (xpos, ypos) as get_position, but evaluating it is a handful of multiply-adds per point, it works at
+    any camera resolution (positions are normalized by the image size, the grid assets get stretched to every
+    resolution anyway) and it's a few dozen numbers instead of full size grid images and maps.
+
+    It doesn't agree with the position maps everywhere. Where the maps have every grid line (1000x1000 and up)
+    half the workspace is within about 0.4 mm of them and 95% within 1 mm, but along the outermost crossings the
+    maps number the lines off by one and the two are 5 to 30 mm apart. At 1280x720 the resize loses grid lines,
+    every line lost shifts the maps by 5 mm below it, and the two are a median 5 mm (95%: 20 mm) apart inside the
+    crossings. The crossings the maps number wrong are left out of the fit (see lattice_indices), so the model
+    stays on the actual grid: fitted at 1280x720 it's within 0.6 mm of the one fitted at 3280x2464.
+
+    The model also keeps the grid_extent of the vertical grid as a fraction of the image size, which is all the
+    gantry mask needs, so with a saved model the grid images don't have to be loaded at all. That gives back the
+    same rows and columns at the resolution it was fitted at; elsewhere it's within a few pixels of what the
+    resized grid gives (up to 4 px at 3280x2464 for a model fitted at 1000x1000, the resize doesn't scale the
+    grid lines exactly).
+    """
+
+    def __init__(self, homography, correction, order, extent=None):
+        self.homography = np.asarray(homography, dtype=np.float64)
+        self.correction = np.asarray(correction, dtype=np.float64)
+        self.order = int(order)
+        # (min_y, max_y + 1, min_x, max_x + 1) of the grid lines over the image size, None for models saved
+        # before it was kept
+        self.extent = None if extent is None else np.asarray(extent, dtype=np.float64)
+
+    @staticmethod
+    def features(uv, order):
+        # all monomials u^i v^j with i + j <= order
+        u, v = uv[:, 0], uv[:, 1]
+        return np.column_stack([u**i * v**(total - i) for total in range(order + 1) for i in range(total + 1)])
+
+    @staticmethod
+    def normalize(points, shape):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        return (points + 0.5) / [shape[1], shape[0]]
+
+    @classmethod
+    def fit(cls, grid_horizontal, grid_vertical, maps, order=3):
+        """
+        :param grid_horizontal: horizontal grid line image array
+        :param grid_vertical: vertical grid line image array (its extent gets kept for the gantry mask)
+        :param maps: position_maps of the two grids (only used to number the grid lines)
+        :param order: order of the polynomial correction
+        :return: fitted GridModel, RMS error at the crossings in mm
+        """
+        pixels, mm = grid_intersections(grid_horizontal, grid_vertical, maps)
+        # the maps number the lines wrong wherever the resize lost one, only keep the crossings whose numbers
+        # agree with the crossings' own layout
+        indices, found = lattice_indices(pixels)
+        steps = np.round(mm / 5).astype(int) - indices
+        agree = np.zeros(len(pixels), dtype=bool)
+        if found.any():
+            values, counts = np.unique(steps[found], axis=0, return_counts=True)
+            agree = found & np.all(steps == values[np.argmax(counts)], axis=1)
+        pixels, mm = pixels[agree], mm[agree]
+        uv = cls.normalize(pixels, np.shape(grid_horizontal))
+        homography, inliers = cv2.findHomography(uv, mm, cv2.RANSAC, 1.0)
+        if homography is None:
+            raise ValueError("couldn't fit the grid, only {} crossings found".format(len(pixels)))
+        inliers = inliers.ravel().astype(bool)
+        projected = cv2.perspectiveTransform(uv[None], homography)[0]
+        correction, _, _, _ = np.linalg.lstsq(cls.features(uv[inliers], order), (mm - projected)[inliers],
+                                              rcond=None)
+        height, width = np.shape(grid_vertical)
+        min_y, max_y, min_x, max_x = grid_extent(grid_vertical)
+        extent = [min_y / height, (max_y + 1) / height, min_x / width, (max_x + 1) / width]
+        model = cls(homography, correction, order, extent)
+        xpos, ypos = model.lookup(pixels[inliers], np.shape(grid_horizontal))
+        error = np.hypot(xpos - mm[inliers, 0], ypos - mm[inliers, 1])
+        return model, float(np.sqrt(np.mean(error**2)))
+
+    def lookup(self, sites, shape):
+        """
+        :param sites: an [x, y] position or an Nx2 array of them
+        :param shape: shape of the image the sites are in (any resolution)
+        :return: mm positions the same way lookup_position gives them, as two numbers or two arrays of N
+        """
+        points = np.asarray(sites, dtype=np.float64)
+        uv = self.normalize(points, shape)
+        mm = cv2.perspectiveTransform(uv[None], self.homography)[0] + self.features(uv, self.order) @ self.correction
+        if points.ndim == 1:
+            return float(mm[0, 0]), float(mm[0, 1])
+        return mm[:, 0], mm[:, 1]
+
+    def inverse(self, xpos, ypos, shape, iterations=5):
+        """
+        :param xpos: mm position(s) going down, same as lookup gives them
+        :param ypos: mm position(s) going across
+        :param shape: shape of the image to get pixel positions in
+        :param iterations: rounds of undoing the polynomial correction (it's small, so this settles fast)
+        :return: [x, y] pixel position, or an Nx2 array of them
+        """
+        single = np.ndim(xpos) == 0
+        mm = np.column_stack((np.ravel(xpos), np.ravel(ypos))).astype(np.float64)
+        inverse = np.linalg.inv(self.homography)
+        uv = cv2.perspectiveTransform(mm[None], inverse)[0]
+        for _ in range(iterations):
+            uv = cv2.perspectiveTransform((mm - self.features(uv, self.order) @ self.correction)[None], inverse)[0]
+        points = uv * [shape[1], shape[0]] - 0.5
+        if single:
+            return points[0]
+        return points
+
+    def extent_at(self, shape):
+        """
+        :param shape: shape of the camera images
+        :return: grid_extent of the vertical grid at that resolution
+        """
+        height, width = shape[:2]
+        min_y, end_y, min_x, end_x = np.round(self.extent * [height, height, width, width]).astype(int)
+        return int(min_y), int(end_y) - 1, int(min_x), int(end_x) - 1
+
+    def save(self, path):
+        extra = {} if self.extent is None else {'extent': self.extent}
+        np.savez(path, homography=self.homography, correction=self.correction, order=self.order, **extra)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            extent = data['extent'] if 'extent' in data.files else None
+            return cls(data['homography'], data['correction'], data['order'], extent)